@@ -0,0 +1,115 @@
+# auth.py
+# server.py 的 token 校验，和 server10.go 的 verifyToken 走同一个平台接口：
+# POST {AUTH_SERVICE_URL}/check-token，返回 {"valid", "openid", "user_id", "username", "exp", ...}
+# 与 Go 版本每个连接新建一个 HTTP 客户端不同，这里所有连接共用一个带连接池的 aiohttp 会话，
+# 校验结果放进有上限的 TTL 缓存，同一个 token 的并发校验只发一次请求，
+# 服务器重启后所有客户端同时重连时不会把认证服务打爆。
+import asyncio
+import collections
+import time
+
+
+class TokenCache:
+    """有容量上限的 TTL 缓存，超出容量时淘汰最久没用过的 token。"""
+
+    def __init__(self, max_entries=10000, ttl=300.0, negative_ttl=5.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = collections.OrderedDict()  # token -> (过期时间, 结果或 None)
+
+    def get(self, token):
+        entry = self.entries.get(token)
+        if entry is None:
+            return None
+        expires, result = entry
+        if expires <= time.monotonic():
+            del self.entries[token]
+            return None
+        self.entries.move_to_end(token)
+        return entry
+
+    def put(self, token, result):
+        now = time.monotonic()
+        if result is None:
+            ttl = self.negative_ttl
+        else:
+            ttl = self.ttl
+            if isinstance(result.get("exp"), (int, float)):
+                # 不能缓存到 token 自己过期之后
+                ttl = min(ttl, result["exp"] - time.time())
+        if ttl <= 0:
+            return
+        self.entries[token] = (now + ttl, result)
+        self.entries.move_to_end(token)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class Authenticator:
+    def __init__(self, service_url, internal_key, app_id="desktop_app",
+                 pool_size=32, timeout=5.0, cache=None):
+        self.url = service_url.rstrip("/") + "/check-token"
+        self.internal_key = internal_key
+        self.app_id = app_id
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.cache = cache or TokenCache()
+        self.inflight = {}  # token -> Future，合并同一 token 的并发校验
+        self.session = None
+        self.requests = 0
+
+    async def _session(self):
+        if self.session is None:
+            # aiohttp 是可选依赖，只有启用认证时才需要
+            import aiohttp
+
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=30),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"X-Internal-Auth": self.internal_key},
+            )
+        return self.session
+
+    async def verify(self, token, openid):
+        """返回认证服务给出的用户信息，token 无效或 openid 不匹配时返回 None。"""
+        if not isinstance(token, str) or not token:
+            return None  # 客户端发来的 JSON 里什么类型都可能有，不是字符串的 token 连缓存的键都当不了
+        cached = self.cache.get(token)
+        if cached is not None:
+            result = cached[1]
+        else:
+            fut = self.inflight.get(token)
+            if fut is None:
+                fut = asyncio.ensure_future(self._check(token))
+                self.inflight[token] = fut
+                fut.add_done_callback(lambda _: self.inflight.pop(token, None))
+            result = await asyncio.shield(fut)
+        if result is None or result.get("openid") != openid:
+            return None
+        return result
+
+    async def _check(self, token):
+        import aiohttp
+
+        session = await self._session()
+        self.requests += 1
+        try:
+            async with session.post(self.url, json={"token": token, "app_id": self.app_id}) as resp:
+                if resp.status != 200:
+                    result = None
+                else:
+                    body = await resp.json(content_type=None)
+                    # 认证服务回的不是对象、或者 openid 不是字符串，都按无效处理
+                    valid = isinstance(body, dict) and body.get("valid") and isinstance(body.get("openid"), str)
+                    result = body if valid else None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            # 认证服务本身出问题不写缓存，下一次重试
+            print(f"Token check failed: {e!r}")
+            return None
+        self.cache.put(token, result)
+        return result
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
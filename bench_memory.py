@@ -0,0 +1,131 @@
+# bench_memory.py
+# 每连接内存基准：在本机启动 server.py，分几档（默认 1k/5k/10k）建立大多数时间空闲的连接，
+# 每档都等连接静下来后量服务器进程的常驻内存，报告 (RSS - 空载 RSS) / 连接数。
+# 每个客户端加入房间后发一条聊天，让压缩上下文、发送队列这些按需创建的东西都至少用过一次。
+#   python bench_memory.py                                      默认档位
+#   python bench_memory.py --server-opt SOCKET_PROFILE=lowmem  低内存档位
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+
+import websockets
+
+from test_connect import rss_kb, start_server, wait_for_server
+
+
+async def hold(uri, conn, index, procs, room_size, compression):
+    # 按父进程给的目标数量逐步加连接，加完回报，连接一直保持到父进程说结束
+    clients = []
+    while True:
+        target = await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+        if target is None:
+            break
+        failures = 0
+        while len(clients) < target:
+            i = len(clients) * procs + index
+            try:
+                ws = await websockets.connect(uri, ping_interval=None, close_timeout=1,
+                                              compression=compression, open_timeout=30)
+            except (OSError, websockets.WebSocketException, asyncio.TimeoutError):
+                failures += 1
+                await asyncio.sleep(0.5)
+                continue
+            await ws.send(json.dumps({"type": "join", "room": f"mem-{i // room_size}", "player_id": f"p{i}"}))
+            await ws.send(json.dumps({"type": "chat", "player_id": f"p{i}", "text": "hi " * 100}))
+            clients.append(ws)
+            asyncio.create_task(drain(ws))
+        conn.send(failures)
+    await asyncio.gather(*(ws.close() for ws in clients), return_exceptions=True)
+
+
+async def drain(ws):
+    # 把服务器发来的东西读掉，不让客户端这边的接收队列顶住服务器的发送
+    try:
+        async for _ in ws:
+            pass
+    except websockets.ConnectionClosed:
+        pass
+
+
+def hold_proc(uri, conn, index, procs, room_size, compression):
+    asyncio.run(hold(uri, conn, index, procs, room_size, compression))
+
+
+def run(args):
+    server = start_server(args)
+    uri = f"ws://127.0.0.1:{args.port}"
+    ctx = multiprocessing.get_context()
+    pipes = [ctx.Pipe() for _ in range(args.procs)]
+    procs = [ctx.Process(target=hold_proc, args=(uri, child, i, args.procs, args.room_size, args.compression))
+             for i, (_, child) in enumerate(pipes)]
+    steps = []
+    try:
+        asyncio.run(wait_for_server(uri))
+        time.sleep(args.settle)
+        idle = rss_kb(server.pid)
+        for p in procs:
+            p.start()
+        for total in args.steps:
+            start = time.time()
+            for i, (parent, _) in enumerate(pipes):
+                parent.send(total // args.procs + (i < total % args.procs))
+            failures = sum(parent.recv() for parent, _ in pipes)
+            connect_seconds = time.time() - start
+            # 等连接都空闲下来（空闲释放、心跳都至少走过一轮）再量
+            time.sleep(args.settle)
+            rss = rss_kb(server.pid)
+            steps.append({"connections": total, "rss_kb": rss,
+                          "per_connection_kb": round((rss - idle) / total, 2) if rss and idle else None,
+                          "connect_seconds": round(connect_seconds, 2), "failed_attempts": failures})
+        for parent, _ in pipes:
+            parent.send(None)
+        for p in procs:
+            p.join(timeout=30)
+    finally:
+        server.terminate()
+        server.wait()
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+    return {"server_opt": args.server_opt, "client_compression": args.compression, "idle_rss_kb": idle,
+            "steps": steps}
+
+
+def report(result):
+    opts = " ".join(result["server_opt"]) or "defaults"
+    print(f"server options: {opts}; client compression: {result['client_compression']}")
+    print(f"idle server RSS {result['idle_rss_kb'] / 1024:.1f} MiB")
+    print(f"{'connections':>12} {'RSS MiB':>10} {'KiB/conn':>10} {'connect s':>10} {'failed':>7}")
+    for s in result["steps"]:
+        print(f"{s['connections']:>12} {s['rss_kb'] / 1024:>10.1f} {s['per_connection_kb']:>10.2f} "
+              f"{s['connect_seconds']:>10.2f} {s['failed_attempts']:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server resident memory per idle connection")
+    parser.add_argument("--steps", default="1000,5000,10000",
+                        help="comma-separated connection counts to measure at")
+    parser.add_argument("--room-size", type=int, default=8)
+    parser.add_argument("--compression", default="deflate", choices=("deflate", "none"),
+                        help="whether clients offer permessage-deflate (client10.py does)")
+    parser.add_argument("--settle", type=float, default=5.0, help="seconds to wait before each measurement")
+    parser.add_argument("--procs", type=int, default=max(1, multiprocessing.cpu_count() - 1))
+    parser.add_argument("--port", type=int, default=18766)
+    parser.add_argument("--server-opt", action="append", default=[], metavar="NAME=VALUE",
+                        help="override a server.py setting, e.g. SOCKET_PROFILE=lowmem")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+    args.steps = [int(s) for s in args.steps.split(",")]
+    if args.compression == "none":
+        args.compression = None
+    result = run(args)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        report(result)
+
+
+if __name__ == "__main__":
+    main()
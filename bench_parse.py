@@ -0,0 +1,53 @@
+# bench_parse.py
+# 微基准：每条转发的 action/chat 帧，旧路径（json.loads 整帧）和快速路径（只嗅探 type）各花多少 CPU
+import json
+import timeit
+
+from server import fast_kind
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FRAMES = {
+    "action": json.dumps({"type": "action", "player_id": 140234567890123}),
+    "chat": json.dumps({"type": "chat", "player_id": 140234567890123, "text": "大家好，今天一起摸鱼吗？" * 4}),
+}
+
+
+def old_path(msg):
+    # 旧实现：websockets 先把文本帧解码成 str，再完整 json.loads 一遍
+    data = json.loads(msg.decode("utf-8"))
+    return data["type"] in ("action", "chat")
+
+
+def orjson_path(msg):
+    return orjson.loads(msg)["type"] in ("action", "chat")
+
+
+def fast_path(msg):
+    return fast_kind(msg) is not None
+
+
+def measure(fn, msg, number):
+    best = min(timeit.repeat(lambda: fn(msg), number=number, repeat=5))
+    return best / number * 1e9
+
+
+def main(number=200000):
+    print(f"{'frame':<8} {'path':<12} {'ns/msg':>8} {'saved':>8}")
+    for name, text in FRAMES.items():
+        msg = text.encode("utf-8")
+        base = measure(old_path, msg, number)
+        paths = [("json.loads", old_path)]
+        if orjson is not None:
+            paths.append(("orjson", orjson_path))
+        paths.append(("fast path", fast_path))
+        for label, fn in paths:
+            ns = base if fn is old_path else measure(fn, msg, number)
+            print(f"{name:<8} {label:<12} {ns:>8.0f} {base - ns:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
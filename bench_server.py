@@ -0,0 +1,314 @@
+# bench_server.py
+# server.py 吞吐回归基准：在同一个进程里用假的 WebSocket 连接直接驱动 server.handler，
+# 不经过网络和握手，只测服务器自己的转发/扇出/房间目录代码。
+#   python bench_server.py --save bench_baseline.json      跑一遍并保存基线
+#   python bench_server.py --compare bench_baseline.json   和基线比较，慢了超过 --threshold 就报回归（退出码 1）
+import argparse
+import asyncio
+import collections
+import json
+import platform
+import statistics
+import sys
+import time
+import types
+
+import websockets
+
+import server
+
+# 基准测的是转发本身，限流放到不会触发，但令牌桶的开销仍然算在里面
+UNLIMITED = {"action": (1e12, 1e12), "chat": (1e12, 1e12)}
+
+
+class FakeWebSocket:
+    """handler 用到的那部分连接接口：recv 从 inbox 取帧，send 只计数。"""
+
+    subprotocol = None
+    on_send = None  # 需要知道每一帧什么时候写出的场景设置，参数是帧
+
+    def __init__(self, bench):
+        self.bench = bench
+        self.inbox = collections.deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.replies = []  # 只在 keep_replies 时记录，给需要看回复内容的场景用
+        self.keep_replies = False
+        self.protocol = types.SimpleNamespace(extensions=[])
+
+    def feed(self, frame):
+        self.inbox.append(frame if isinstance(frame, bytes) else frame.encode("utf-8"))
+        self.ready.set()
+
+    async def recv(self, decode=None):
+        # 真实连接每读一帧都可能让出事件循环，这里也让一次，writer 任务才有机会把队列发掉
+        await asyncio.sleep(0)
+        while not self.inbox:
+            if self.closed:
+                raise websockets.ConnectionClosedOK(None, None)
+            self.ready.clear()
+            await self.ready.wait()
+        return self.inbox.popleft()
+
+    async def send(self, frame, text=None):
+        if self.keep_replies:
+            self.replies.append(frame)
+        if self.on_send is not None:
+            self.on_send(frame)
+        self.bench.sent()
+
+    async def close(self, code=1000, reason=""):
+        self.closed = True
+        self.ready.set()
+
+
+class Bench:
+    def __init__(self):
+        self.delivered = 0
+        self.target = None
+        self.done = None
+        self.tasks = []
+
+    def sent(self):
+        self.delivered += 1
+        if self.target is not None and self.delivered >= self.target:
+            self.done.set()
+
+    def connect(self):
+        ws = FakeWebSocket(self)
+        self.tasks.append(asyncio.create_task(server.handler(ws)))
+        return ws
+
+    async def wait_for(self, count):
+        """等到一共发出 count 帧。"""
+        self.target = count
+        self.done = asyncio.Event()
+        if self.delivered < count:
+            await self.done.wait()
+        self.target = None
+
+    async def join(self, room, n):
+        members = [self.connect() for _ in range(n)]
+        for i, ws in enumerate(members):
+            ws.feed(json.dumps({"type": "join", "room": room}))
+            # 每人一条 room_players，已经在房间里的人各收到一条 player_joined
+            await self.wait_for(self.delivered + 1 + i)
+        return members
+
+    async def close(self):
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+def reset_server():
+    server.rooms.clear()
+    server.conns.clear()
+    server.room_stats.clear()
+    server.pending_actions.clear()
+    server.sessions.clear()
+    server.idle_rooms.clear()
+    server.directory = server.RoomDirectory()
+    server.RATE_LIMITS = UNLIMITED
+    server.ACTION_TICK = 0
+    server.RESUME_GRACE = 0  # 断开的连接马上从名单里删掉，player_left 在场景内就能发完
+    server.ROOM_ACTORS = True
+
+
+async def fanout(room_size, deliveries):
+    # 一个房间，一个人不停地发 action，测每秒写给接收方的帧数
+    bench = Bench()
+    members = await bench.join("fanout", room_size)
+    frames = max(1, deliveries // (room_size - 1))
+    frame = json.dumps({"type": "action", "player_id": 1})
+    start = bench.delivered
+    t0 = time.perf_counter()
+    for _ in range(frames):
+        members[0].feed(frame)
+    await bench.wait_for(start + frames * (room_size - 1))
+    elapsed = time.perf_counter() - t0
+    await bench.close()
+    return frames * (room_size - 1) / elapsed
+
+
+async def many_rooms(rooms, room_size, frames_per_room):
+    # 很多小房间同时有人发言
+    bench = Bench()
+    senders = []
+    for i in range(rooms):
+        senders.append((await bench.join(f"small-{i}", room_size))[0])
+    frame = json.dumps({"type": "chat", "player_id": 1, "text": "hello there"})
+    total = rooms * frames_per_room * (room_size - 1)
+    start = bench.delivered
+    t0 = time.perf_counter()
+    for _ in range(frames_per_room):
+        for ws in senders:
+            ws.feed(frame)
+    await bench.wait_for(start + total)
+    elapsed = time.perf_counter() - t0
+    await bench.close()
+    return total / elapsed
+
+
+async def list_rooms(rooms, requests, paging):
+    # 10k 个房间时的 list_rooms：paging=False 反复取第一页（走缓存），True 翻遍所有页
+    bench = Bench()
+    for i in range(rooms):
+        await bench.join(f"room-{i:05d}", 1)
+    client = bench.connect()
+    pages = max(1, rooms // server.ROOM_LIST_PAGE_SIZE)
+    start = bench.delivered
+    t0 = time.perf_counter()
+    done = 0
+    while done < requests:
+        batch = min(pages if paging else requests, requests - done)
+        for i in range(batch):
+            offset = i * server.ROOM_LIST_PAGE_SIZE if paging else 0
+            client.feed(json.dumps({"type": "list_rooms", "offset": offset}))
+        done += batch
+        if paging:
+            # 等这一遍的回复都发出去（请求在 handler 里才处理），再让目录变一次，下一遍的每一页都要重新生成
+            await bench.wait_for(start + done)
+            server.directory._changed()
+    await bench.wait_for(start + requests)
+    elapsed = time.perf_counter() - t0
+    await bench.close()
+    return requests / elapsed
+
+
+async def join_churn(room_size, joins):
+    # 固定成员的房间里不停有人进出，测每秒完成的 加入 + 离开，包括给房间里每个人发的 player_joined/player_left
+    bench = Bench()
+    await bench.join("churn", room_size)
+    t0 = time.perf_counter()
+    for _ in range(joins):
+        ws = bench.connect()
+        task = bench.tasks.pop()
+        ws.feed(json.dumps({"type": "join", "room": "churn"}))
+        await bench.wait_for(bench.delivered + 1 + room_size)
+        await ws.close()
+        await task
+        await bench.wait_for(bench.delivered + room_size)
+    elapsed = time.perf_counter() - t0
+    await bench.close()
+    return joins / elapsed
+
+
+async def hot_cold(actors, hot_rooms, hot_size, hot_senders, cold_rooms, cold_size, samples):
+    # 几个大房间里很多人一直在发，同时很多小房间偶尔有人发一帧：测小房间从收到到写出的 p99 延迟（毫秒）。
+    # actors 切换 ROOM_ACTORS，两种扇出方式用同一份负载比较
+    server.ROOM_ACTORS = actors
+    bench = Bench()
+    hot = [await bench.join(f"hot-{i}", hot_size) for i in range(hot_rooms)]
+    cold = [await bench.join(f"cold-{i}", cold_size) for i in range(cold_rooms)]
+    sent_at = {}
+    latencies = []
+
+    def record(frame):
+        t0 = sent_at.get(frame)
+        if t0 is not None:
+            latencies.append(time.perf_counter() - t0)
+
+    for members in cold:
+        for ws in members[1:]:
+            ws.on_send = record
+    # 热门房间的发送者一直有帧可读，够撑到冷门房间的样本采完
+    frame = json.dumps({"type": "action", "player_id": 1}).encode()
+    per_sender = samples * 4
+    for members in hot:
+        for ws in members[:hot_senders]:
+            for _ in range(per_sender):
+                ws.feed(frame)
+    for n in range(samples):
+        ws = cold[n % cold_rooms][0]
+        probe = json.dumps({"type": "action", "player_id": 1, "n": n}).encode()
+        sent_at[probe] = time.perf_counter()
+        ws.feed(probe)
+        await asyncio.sleep(0.001)
+    while len(latencies) < samples * (cold_size - 1):
+        await asyncio.sleep(0.001)
+    await bench.close()
+    latencies.sort()
+    return latencies[int(len(latencies) * 0.99)] * 1000
+
+
+def scenarios(scale):
+    n = lambda x: max(1, int(x * scale))
+    s = {}
+    for size in (2, 10, 100, 1000):
+        s[f"fanout_{size}"] = ("deliveries/s", lambda size=size: fanout(size, n(100_000)))
+    s["many_small_rooms"] = ("deliveries/s", lambda: many_rooms(n(2000), 4, 20))
+    s["list_rooms_10k_cached"] = ("requests/s", lambda: list_rooms(10_000, n(20_000), paging=False))
+    s["list_rooms_10k_paging"] = ("requests/s", lambda: list_rooms(10_000, n(5_000), paging=True))
+    s["join_churn"] = ("joins/s", lambda: join_churn(50, n(5_000)))
+    for name, actors in (("inline", False), ("actors", True)):
+        s[f"hot_cold_{name}_p99"] = ("ms", lambda actors=actors: hot_cold(actors, 2, 300, 20, 50, 4, n(300)))
+    return s
+
+
+def run_scenario(factory, repeat):
+    results = []
+    for _ in range(repeat):
+        reset_server()
+        results.append(asyncio.run(factory()))
+    return statistics.median(results)
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f"{'scenario':<24} {'baseline':>14} {'now':>14} {'change':>8}")
+    for name, r in results.items():
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            print(f"{name:<24} {'-':>14} {r['value']:>14.1f}")
+            continue
+        change = r["value"] / base["value"] - 1
+        # 延迟类场景（单位 ms）越小越好
+        slower = change if r["unit"] == "ms" else -change
+        flag = ""
+        if slower > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<24} {base['value']:>14.1f} {r['value']:>14.1f} {change:>+7.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-process throughput benchmarks for server.py")
+    parser.add_argument("--only", nargs="*", help="run only these scenarios")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per scenario; the median is reported")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the work per scenario")
+    parser.add_argument("--save", metavar="FILE", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare with a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="slowdown that counts as a regression (0.10 = 10%%)")
+    args = parser.parse_args()
+
+    # 基准时不开指标端口，但指标计数本身照常进行
+    server.METRICS_PORT = None
+    all_scenarios = scenarios(args.scale)
+    names = args.only or list(all_scenarios)
+    results = {}
+    for name in names:
+        unit, factory = all_scenarios[name]
+        value = run_scenario(factory, args.repeat)
+        results[name] = {"value": round(value, 1), "unit": unit}
+        if not args.compare:
+            print(f"{name:<24} {value:>14.1f} {unit}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "scale": args.scale, "results": results}, f, indent=2)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) above {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# bench_workers.py
+# 本地基准：分别用 1..N 个 worker 启动 launcher.py，测每秒转发给接收方的消息数
+import argparse
+import asyncio
+import json
+import multiprocessing
+import subprocess
+import sys
+import time
+
+import websockets
+
+
+def connect(port):
+    # 压测时客户端自己也很忙，关掉心跳避免把 ping 超时算进结果
+    return websockets.connect(f"ws://127.0.0.1:{port}", ping_interval=None, close_timeout=1)
+
+
+async def join(port, room):
+    ws = await connect(port)
+    while True:
+        await ws.send(json.dumps({"type": "join", "room": room, "password": None}))
+        reply = json.loads(await ws.recv())
+        if reply["type"] != "redirect":
+            return ws
+        # 房间在别的 worker 上，跟随重定向
+        await ws.close()
+        ws = await connect(reply["port"])
+
+
+async def run_rooms(port, rooms, room_size, duration):
+    members = []
+    for room in rooms:
+        members.append([await join(port, room) for _ in range(room_size)])
+    received = 0
+    stop = asyncio.Event()
+
+    async def send_loop(ws):
+        frame = json.dumps({"type": "action", "player_id": id(ws)})
+        while not stop.is_set():
+            await ws.send(frame)
+            await asyncio.sleep(0)
+
+    async def recv_loop(ws):
+        nonlocal received
+        async for _ in ws:
+            received += 1
+
+    tasks = []
+    for room in members:
+        tasks.append(asyncio.create_task(send_loop(room[0])))
+        tasks.extend(asyncio.create_task(recv_loop(ws)) for ws in room[1:])
+    await asyncio.sleep(duration)
+    stop.set()
+    result = received
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*(ws.close() for room in members for ws in room))
+    return result
+
+
+def client_proc(port, rooms, room_size, duration):
+    return asyncio.run(run_rooms(port, rooms, room_size, duration))
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            asyncio.run(_probe(port))
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+async def _probe(port):
+    async with websockets.connect(f"ws://127.0.0.1:{port}"):
+        pass
+
+
+def bench(workers, args):
+    server = subprocess.Popen(
+        # 不写房间快照：否则下一档 worker 数（或者之后真正启动的 launcher）会把 bench-* 房间恢复出来
+        [sys.executable, "launcher.py", "--workers", str(workers), "--host", "127.0.0.1", "--port", str(args.port),
+         "--no-snapshot"],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(args.port)
+        time.sleep(0.5)  # 等所有 worker 都绑定好独立端口
+        names = [f"bench-{i}" for i in range(args.rooms)]
+        chunks = [names[i::args.client_procs] for i in range(args.client_procs)]
+        with multiprocessing.Pool(args.client_procs) as pool:
+            counts = pool.starmap(
+                client_proc, [(args.port, chunk, args.room_size, args.duration) for chunk in chunks if chunk]
+            )
+        return sum(counts) / args.duration
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relayed messages per second with 1..N server workers")
+    parser.add_argument("--max-workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--rooms", type=int, default=32)
+    parser.add_argument("--room-size", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--client-procs", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--port", type=int, default=18765)
+    args = parser.parse_args()
+
+    baseline = None
+    print(f"{'workers':>8} {'msgs/s':>12} {'speedup':>8}")
+    for workers in range(1, args.max_workers + 1):
+        rate = bench(workers, args)
+        baseline = baseline or rate
+        print(f"{workers:>8} {rate:>12.0f} {rate / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,10 @@ import sys, os
 from pynput import mouse, keyboard
 import requests  # 添加requests库用于HTTP请求
 import uuid
+import random
+import compression
+import relay_trace
+import wire
 
 import os
 import sys
@@ -24,6 +28,13 @@ from pyupdater.client import Client
 # 平台API地址
 PLATFORM_API = "http://localhost:8080"  # 假设API网关运行在本地8080端口
 
+# 转发延迟追踪：按这个比例给发出的 action/chat 加时间戳，0 表示不追踪；每收齐这么多个样本打印一次各段延迟
+TRACE_SAMPLE_RATE = 0.0
+TRACE_REPORT_EVERY = 100
+
+# 别的玩家转发来的一帧 action 最多播放这么多次（count 是对方填的，不可信）
+MAX_ACTION_COUNT = 100
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -270,6 +281,7 @@ class DesktopPet:
         self.events = []  # 最近1秒的动作事件
         self.chat_text = None
         self.chat_label = None
+        self.closed = False
 
         # 拖动支持
         self.label.bind("<Button-1>", self.start_move)
@@ -312,12 +324,18 @@ class DesktopPet:
     def send_chat(self, event=None):
         text = self.chat_entry.get()
         if text.strip() and self.ws:
-            asyncio.run_coroutine_threadsafe(self.ws.send(json.dumps({
-                "type":"chat","player_id":self.player_id,"text":text
-            })), asyncio.get_event_loop())
+            event = {"type":"chat","player_id":self.player_id,"text":text}
+            traced = relay_trace.maybe_start(event, TRACE_SAMPLE_RATE, time.time())
+            if self.ws.subprotocol == wire.SUBPROTOCOL_BINARY and not traced:
+                frame = wire.encode_chat(text)
+            else:
+                frame = json.dumps(event)
+            asyncio.run_coroutine_threadsafe(self.ws.send(frame), asyncio.get_event_loop())
             self.chat_entry.delete(0, tk.END)
 
     def animate(self):
+        if self.closed:
+            return
         now = time.time()
         # 保留最近1秒动作事件
         self.events = [t for t in self.events if now - t < 1]
@@ -360,17 +378,30 @@ class DesktopPet:
     def trigger_action(self):
         self.events.append(time.time())
         if self.ws:
-            asyncio.run_coroutine_threadsafe(self.ws.send(json.dumps({
-                "type":"action","player_id":self.player_id
-            })), asyncio.get_event_loop())
+            event = {"type":"action","player_id":self.player_id}
+            traced = relay_trace.maybe_start(event, TRACE_SAMPLE_RATE, time.time())
+            if self.ws.subprotocol == wire.SUBPROTOCOL_BINARY and not traced:
+                frame = wire.encode_action()
+            else:
+                frame = json.dumps(event)
+            asyncio.run_coroutine_threadsafe(self.ws.send(frame), asyncio.get_event_loop())
 
-    def receive_action(self):
-        self.events.append(time.time())
+    def receive_action(self, count=1):
+        # count 来自转发的帧：不是正整数就当 1 次，太大的截到 MAX_ACTION_COUNT
+        if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+            count = 1
+        now = time.time()
+        self.events.extend([now] * min(count, MAX_ACTION_COUNT))
 
     def receive_chat(self, text):
         self.chat_text = text
         self.chat_start = time.time()
 
+    def destroy(self):
+        # 玩家离开了房间，停掉动画并关掉宠物窗口
+        self.closed = True
+        self.root.destroy()
+
     def start_listeners(self):
         def on_click(x, y, button, pressed):
             if pressed:
@@ -1009,10 +1040,16 @@ class JiggerClient:
     def __init__(self, sprite_path):
         self.sprite_path = sprite_path
         self.players = {}
+        self.sids = {}  # 二进制协议下房间内短 id -> player_id
+        self.resume_token = None  # 断线重连时凭它回到原房间，只补发漏掉的聊天
+        self.last_seq = 0
+        self.roster_version = None  # 服务器房间名单的版本，增量对不上时重新要完整名单
         self.player_id = id(self)
         self.ws = None
+        self.server_port = 8765
         self.online = False
         self.event_queue = queue.Queue()
+        self.tracer = relay_trace.Tracer()
         self.auth = AuthManager()  # 添加认证管理器
 
         self.root = tk.Tk()
@@ -1034,25 +1071,81 @@ class JiggerClient:
         self.players[player_id] = pet
 
     def process_queue(self):
+        try:
+            self.handle_events()
+        finally:
+            # 一个处理出错的事件不能让之后的事件再也没人处理
+            self.root.after(50, self.process_queue)
+
+    def handle_events(self):
         while not self.event_queue.empty():
             event = self.event_queue.get()
+            if event["type"] == "room_players":
+                # 完整名单：补上没见过的宠物，去掉已经不在房间里的。
+                # partial 的名单（服务器开了房间总线）只有同一个 worker 上的玩家，不能拿来删
+                present = set(event["players"])
+                for pid in list(self.players):
+                    if pid != self.player_id and pid not in present and not event.get("partial"):
+                        self.players.pop(pid).destroy()
+                for pid in present:
+                    if pid != self.player_id and pid not in self.players:
+                        self.start_pet(pid, self.ws, is_self=False)
+                continue
+            if event["type"] == "player_left":
+                if event["player_id"] != self.player_id and event["player_id"] in self.players:
+                    self.players.pop(event["player_id"]).destroy()
+                continue
+            if event["type"] == "actions":
+                # 服务器按 tick 合并的动作批次，自己的动作已经在本地播放过
+                for pid, count in event["actions"]:
+                    if pid == self.player_id:
+                        continue
+                    if pid not in self.players:
+                        self.start_pet(pid, self.ws, is_self=False)
+                    self.players[pid].receive_action(count)
+                continue
             pid = event.get("player_id")
+            if pid is None:
+                # room_players、rate_limited 之类的控制消息不对应某个宠物
+                continue
             if pid not in self.players:
                 self.start_pet(pid, self.ws, is_self=False)
+            if event["type"] == "player_joined":
+                continue
             pet = self.players[pid]
+            trace = event.get("trace")
+            if isinstance(trace, dict) and "cr" in trace:
+                trace["cp"] = time.time()
+                self.tracer.record(trace)
+                if self.tracer.samples % TRACE_REPORT_EVERY == 0:
+                    print(self.tracer.summary())
             if event["type"] == "action":
-                pet.receive_action()
+                pet.receive_action(event.get("count", 1))
             elif event["type"] == "chat":
                 pet.receive_chat(event["text"])
-        self.root.after(50, self.process_queue)
+
+    def decode_binary(self, msg):
+        # 二进制帧里的玩家是房间内短 id，换回 player_id；还不认识的短 id 先单独当一个玩家
+        event = wire.decode(msg)
+        if event["type"] == "actions":
+            event["actions"] = [[self.sids.get(sid, ("sid", sid)), count] for sid, count in event["actions"]]
+        else:
+            sid = event.pop("sid")
+            event["player_id"] = self.sids.get(sid, ("sid", sid))
+        return event
+
+    async def join_room(self):
+        await self.ws.send(json.dumps({"type":"join","room":"room1","password":None,
+                                       "player_id":self.player_id}))
 
     def ws_loop(self):
         asyncio.run(self.ws_main())
 
     async def ws_main(self):
-        uri = "ws://127.0.0.1:8765"
+        uri = f"ws://127.0.0.1:{self.server_port}"
         try:
-            self.ws = await asyncio.wait_for(websockets.connect(uri), timeout=1)
+            self.ws = await asyncio.wait_for(websockets.connect(uri, subprotocols=wire.SUBPROTOCOLS,
+                                                              extensions=compression.client_extensions()), timeout=1)
             self.online = True
             print("联网模式")
             
@@ -1072,8 +1165,17 @@ class JiggerClient:
                 
                 if auth_result.get("type") == "auth_success":
                     print("服务器认证成功")
-                    # 认证成功后加入房间
-                    await self.ws.send(json.dumps({"type":"join","room":"room1","password":None}))
+                    # 认证后服务器用 openid 作为 player_id，本地宠物也改用这个 id
+                    if self.player_id != self.auth.openid:
+                        pet = self.players.pop(self.player_id)
+                        pet.player_id = self.player_id = self.auth.openid
+                        self.players[self.player_id] = pet
+                    # 认证成功后加入房间；断线重连时先尝试续传，失败了再重新加入
+                    if self.resume_token:
+                        await self.ws.send(json.dumps({"type":"resume","token":self.resume_token,
+                                                       "last_seq":self.last_seq}))
+                    else:
+                        await self.join_room()
                 else:
                     print("服务器认证失败:", auth_result.get("reason", "未知错误"))
                     self.online = False
@@ -1094,14 +1196,55 @@ class JiggerClient:
         if self.online:
             try:
                 async for msg in self.ws:
-                    event = json.loads(msg)
+                    try:
+                        event = self.decode_binary(msg) if isinstance(msg, bytes) else json.loads(msg)
+                    except ValueError:
+                        # 服务器原样转发其他玩家的帧，不保证都是合法 JSON，坏帧直接丢掉
+                        continue
+                    if isinstance(event.get("trace"), dict):
+                        event["trace"]["cr"] = time.time()
+                    if event.get("type") == "room_players":
+                        if "sids" in event:
+                            self.sids = {sid: pid for pid, sid in event["sids"]}
+                        if "resume" in event:
+                            self.resume_token = event["resume"]
+                            self.last_seq = event.get("seq", 0)
+                        self.roster_version = event.get("version")
+                    elif event.get("type") in ("player_joined", "player_left") and "version" in event:
+                        # 没有 version 的增量是房间总线转来的其他 worker 上的玩家，不参与版本号检查
+                        if event["type"] == "player_joined":
+                            self.sids[event["sid"]] = event["player_id"]
+                        if self.roster_version is not None and event["version"] != self.roster_version + 1:
+                            # 中间漏了增量，要一份完整名单
+                            await self.ws.send(json.dumps({"type":"roster"}))
+                        self.roster_version = event["version"]
+                    elif event.get("type") == "resumed":
+                        if event.get("roster_version") != self.roster_version:
+                            await self.ws.send(json.dumps({"type":"roster"}))
+                    elif event.get("type") == "resume_failed":
+                        self.resume_token = None
+                        await self.join_room()
+                    elif event.get("type") == "chat" and type(event.get("seq")) is int:
+                        # 服务器只给聊天帧编 seq（而且放在最后，盖过发送者自己填的）；别的帧里的 seq 是对方随便写的
+                        self.last_seq = max(self.last_seq, event["seq"])
+                    if event.get("type") == "reconnect":
+                        # 服务器要重启，按它给的（已经随机错开的）时间后重连，不要所有人同时涌上去
+                        await self.ws.close()
+                        await asyncio.sleep(event.get("after", 5))
+                        return await self.ws_main()
+                    if event.get("type") == "redirect":
+                        # 房间在另一个 server worker 上，改连它的端口重新认证和加入
+                        self.server_port = event["port"]
+                        await self.ws.close()
+                        return await self.ws_main()
                     self.event_queue.put(event)
             except Exception as e:
                 self.online = False
                 print(f"断开连接: {str(e)}，切换单机模式")
 
         while not self.online:
-            await asyncio.sleep(5)
+            # 加一点随机抖动，服务器意外重启时客户端不会齐步重连
+            await asyncio.sleep(5 + random.uniform(0, 5))
             print("尝试重连服务器...")
             await self.ws_main()
             return
@@ -0,0 +1,164 @@
+# compression.py
+# 按消息类型和大小决定是否压缩的 permessage-deflate。
+# RFC 7692 允许发送方逐条消息决定压不压（RSV1 置位与否），所以同一个连接上
+# 小的 action 帧原样发送，聊天记录、房间列表、商城目录这类大消息才走 zlib。
+# 压缩器只在第一次真正需要压缩时才创建，解压器只在收到第一条压缩过的消息时才创建，
+# 只收发小帧的连接省掉那几十 KB 的 zlib 上下文。
+import re
+import time
+import zlib
+
+from websockets.extensions.permessage_deflate import (
+    ClientPerMessageDeflateFactory,
+    PerMessageDeflate,
+    ServerPerMessageDeflateFactory,
+)
+from websockets.frames import CONT, CTRL_OPCODES
+
+import wire
+
+# 每种消息达到多少字节才压缩；None 表示从不压缩，0 表示总是压缩
+DEFAULT_THRESHOLDS = {
+    "action": None,
+    "actions": 1024,
+    "chat": 256,
+    "room_list": 0,
+    "room_players": 512,
+    "chat_history": 0,
+    "market_info": 0,
+    "backpack_info": 0,
+}
+DEFAULT_MIN_SIZE = 512  # 没列出的类型
+
+TYPE_RE = re.compile(rb'\s*\{\s*"type"\s*:\s*"([A-Za-z_]+)"')
+BINARY_TYPES = {wire.MSG_ACTION: "action", wire.MSG_CHAT: "chat", wire.MSG_ACTIONS: "actions",
+                wire.MSG_CHAT_SEQ: "chat"}
+
+
+class CompressionPolicy:
+    def __init__(self, thresholds=None, min_size=DEFAULT_MIN_SIZE):
+        self.thresholds = dict(DEFAULT_THRESHOLDS if thresholds is None else thresholds)
+        self.min_size = min_size
+
+    def message_type(self, data):
+        if wire.is_binary_frame(data):
+            return BINARY_TYPES[data[0]]
+        m = TYPE_RE.match(data)
+        return m.group(1).decode("ascii") if m else None
+
+    def should_compress(self, data):
+        threshold = self.thresholds.get(self.message_type(data), self.min_size)
+        return threshold is not None and len(data) >= threshold
+
+
+class CompressionStats:
+    __slots__ = ("messages", "compressed", "bytes_in", "bytes_out", "skipped_bytes", "cpu")
+
+    def __init__(self):
+        self.messages = self.compressed = 0
+        self.bytes_in = self.bytes_out = self.skipped_bytes = 0
+        self.cpu = 0.0
+
+    def as_dict(self):
+        return {
+            "messages": self.messages,
+            "compressed": self.compressed,
+            "bytes_saved": self.bytes_in - self.bytes_out,
+            "skipped_bytes": self.skipped_bytes,
+            "cpu_ms": round(self.cpu * 1000, 3),
+        }
+
+
+class SelectiveDeflate(PerMessageDeflate):
+    def __init__(self, *args, policy, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.policy = policy
+        self.stats = CompressionStats()
+        self.skip_message = False
+        # 压缩器延迟到第一条需要压缩的消息再创建，解压器延迟到第一条压缩过的消息
+        self.__dict__.pop("encoder", None)
+        self.__dict__.pop("decoder", None)
+
+    @classmethod
+    def from_extension(cls, ext, policy):
+        return cls(
+            ext.remote_no_context_takeover,
+            ext.local_no_context_takeover,
+            ext.remote_max_window_bits,
+            ext.local_max_window_bits,
+            ext.compress_settings,
+            policy=policy,
+        )
+
+    def decode(self, frame, *, max_size=None):
+        if frame.rsv1 and frame.opcode is not CONT and not self.remote_no_context_takeover \
+                and "decoder" not in self.__dict__:
+            self.decoder = zlib.decompressobj(wbits=-self.remote_max_window_bits)
+        return super().decode(frame, max_size=max_size)
+
+    def encode(self, frame):
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+        stats = self.stats
+        if frame.opcode is not CONT:
+            stats.messages += 1
+            self.skip_message = not self.policy.should_compress(frame.data)
+        if self.skip_message:
+            stats.skipped_bytes += len(frame.data)
+            return frame
+        if not self.local_no_context_takeover and "encoder" not in self.__dict__:
+            self.encoder = zlib.compressobj(wbits=-self.local_max_window_bits, **self.compress_settings)
+        start = time.perf_counter()
+        encoded = super().encode(frame)
+        stats.cpu += time.perf_counter() - start
+        if frame.opcode is not CONT:
+            stats.compressed += 1
+        stats.bytes_in += len(frame.data)
+        stats.bytes_out += len(encoded.data)
+        return encoded
+
+
+class ServerSelectiveDeflateFactory(ServerPerMessageDeflateFactory):
+    def __init__(self, policy=None, **kwargs):
+        super().__init__(**kwargs)
+        self.policy = policy or CompressionPolicy()
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, ext = super().process_request_params(params, accepted_extensions)
+        return response_params, SelectiveDeflate.from_extension(ext, self.policy)
+
+
+class ClientSelectiveDeflateFactory(ClientPerMessageDeflateFactory):
+    def __init__(self, policy=None, **kwargs):
+        super().__init__(**kwargs)
+        self.policy = policy or CompressionPolicy()
+
+    def process_response_params(self, params, accepted_extensions):
+        ext = super().process_response_params(params, accepted_extensions)
+        return SelectiveDeflate.from_extension(ext, self.policy)
+
+
+def server_extensions(policy=None, context_takeover=True):
+    # 和 websockets 默认的服务器端设置一样：12 位窗口、memLevel 5。
+    # context_takeover=False 时两个方向都协商 no_context_takeover，zlib 状态每条消息用完就释放，
+    # 压缩率差一些，但空闲连接不再各自占着压缩/解压上下文
+    return [ServerSelectiveDeflateFactory(
+        policy=policy,
+        server_no_context_takeover=not context_takeover,
+        client_no_context_takeover=not context_takeover,
+        server_max_window_bits=12,
+        client_max_window_bits=12,
+        compress_settings={"memLevel": 5},
+    )]
+
+
+def client_extensions(policy=None):
+    return [ClientSelectiveDeflateFactory(policy=policy, compress_settings={"memLevel": 5})]
+
+
+def connection_stats(ws):
+    # 连接上协商到的 SelectiveDeflate 的统计，没有启用压缩时返回 None
+    for ext in ws.protocol.extensions:
+        if isinstance(ext, SelectiveDeflate):
+            return ext.stats
+    return None
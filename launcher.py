@@ -0,0 +1,125 @@
+# launcher.py
+# 多进程启动器：N 个 server.py worker 共享同一个对外端口（SO_REUSEPORT），
+# 房间按一致性哈希固定归属一个 worker，房间状态只存在于该 worker 进程内。
+# 指定 --bus 时不再按房间分片，同一房间的玩家可以分散在不同 worker 上，由房间总线转发。
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+from sharding import HashRing
+
+
+def broker_main(path):
+    import room_bus
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)  # broker 不做采样
+    try:
+        asyncio.run(room_bus.run_broker(path))
+    except KeyboardInterrupt:
+        pass
+
+
+def worker_main(index, host, port, base_port, workers, reuse_port, bus_spec=None, snapshot=True):
+    import server
+
+    # fork 出来的子进程继承了父进程的 SIGTERM 处理，先恢复默认行为；
+    # server.main 起来后会换成自己的处理，terminate() 让 worker 平滑退出并写房间快照
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if hasattr(signal, "SIGUSR1"):
+        # 默认动作是结束进程；server.main 起来前先忽略，起来后换成按需采样
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    server.worker_id = index
+    if not snapshot:
+        server.SNAPSHOT_PATH = None
+    if server.SNAPSHOT_PATH:
+        # 同一个房间重启后仍然哈希到同一个 worker，每个 worker 各存各的
+        server.SNAPSHOT_PATH = f"{server.SNAPSHOT_PATH}.{index}"
+    server.worker_ports = {i: base_port + i for i in range(workers)}
+    if server.METRICS_PORT is not None:
+        # 每个 worker 的指标端口各不相同
+        server.METRICS_PORT += index
+    if bus_spec:
+        server.ROOM_BUS = bus_spec
+    else:
+        server.ring = HashRing(range(workers))
+    if not reuse_port and index != 0:
+        # 不支持 SO_REUSEPORT（例如 Windows）时只有 worker 0 监听对外端口，其余只开独立端口
+        port = None
+    server.install_event_loop()
+    try:
+        asyncio.run(server.main(host, port, reuse_port=reuse_port, private_port=base_port + index))
+    except KeyboardInterrupt:
+        pass
+
+
+def start_broker(path, timeout=5.0):
+    if os.path.exists(path):
+        os.unlink(path)
+    p = multiprocessing.Process(target=broker_main, args=(path,), daemon=True)
+    p.start()
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        if time.time() > deadline:
+            raise RuntimeError(f"room bus broker did not start at {path}")
+        time.sleep(0.05)
+    return p
+
+
+def start_workers(workers, host="0.0.0.0", port=8765, base_port=None, bus_spec=None, snapshot=True):
+    if base_port is None:
+        base_port = port + 1
+    reuse_port = hasattr(socket, "SO_REUSEPORT")
+    procs = []
+    if bus_spec and bus_spec.startswith("unix:"):
+        procs.append(start_broker(bus_spec[len("unix:"):]))
+    for i in range(workers):
+        p = multiprocessing.Process(
+            target=worker_main, args=(i, host, port, base_port, workers, reuse_port, bus_spec, snapshot), daemon=True
+        )
+        p.start()
+        procs.append(p)
+    return procs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run several server.py workers with room-affinity sharding")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--base-port", type=int, default=None,
+                        help="worker i also listens on base_port + i (default: port + 1)")
+    parser.add_argument("--bus", default=None,
+                        help="room bus shared by the workers, e.g. unix:/tmp/jigger-bus.sock; "
+                             "rooms then span workers instead of being sharded")
+    parser.add_argument("--no-snapshot", action="store_true",
+                        help="don't save rooms on shutdown or restore them on start (benchmarks, tests)")
+    args = parser.parse_args()
+
+    # 收到 SIGTERM 时也走 finally，把 worker 一起停掉，避免留下占着端口的孤儿进程
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    procs = start_workers(args.workers, args.host, args.port, args.base_port, args.bus, snapshot=not args.no_snapshot)
+    if hasattr(signal, "SIGUSR1"):
+        # kill -USR1 launcher 等于给每个 worker 发一次，各自采样写到自己的文件
+        signal.signal(signal.SIGUSR1, lambda *_: [os.kill(p.pid, signal.SIGUSR1) for p in procs])
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs:
+            p.terminate()
+        # 等 worker 发完 reconnect 通知、写好快照
+        for p in procs:
+            p.join(timeout=30)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# metrics.py
+# server.py 的运行指标，Prometheus 文本格式，从独立的 HTTP 端口 GET /metrics 拉取。
+# 热路径上只做字典里的整数自增和直方图分桶，其余（连接积压分布、最热房间）都在被抓取时才计算，
+# 所以可以在线上一直开着。
+import asyncio
+import bisect
+import time
+
+# 延迟类直方图的默认分桶（秒）
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Counter:
+    """按标签值计数，labels 只支持一个标签，够 server.py 用了。"""
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, key=None, n=1):
+        self.values[key] = self.values.get(key, 0) + n
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in self.values.items():
+            yield f"{self.name}{_labels(self.label, key)} {value}"
+
+
+class Gauge:
+    """抓取时调用 func 取值；func 返回数字，或者 {标签值: 数字}。"""
+
+    def __init__(self, name, help, func, label=None):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.label = label
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        value = self.func()
+        if isinstance(value, dict):
+            for key, v in value.items():
+                yield f"{self.name}{_labels(self.label, key)} {v}"
+        else:
+            yield f"{self.name} {value}"
+
+
+class Histogram:
+    __slots__ = ("name", "help", "buckets", "counts", "sum", "count")
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一格是 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def quantile(self, q):
+        # 按分桶上界估算分位数，给基准脚本打印用
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            yield f'{self.name}_bucket{{le="{bound}"}} {seen}'
+        yield f'{self.name}_bucket{{le="+Inf"}} {self.count}'
+        yield f"{self.name}_sum {self.sum}"
+        yield f"{self.name}_count {self.count}"
+
+
+def _labels(label, key):
+    if label is None or key is None:
+        return ""
+    value = str(key).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{{{label}="{value}"}}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label=None):
+        return self.add(Counter(name, help, label))
+
+    def gauge(self, name, help, func, label=None):
+        return self.add(Gauge(name, help, func, label))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        lines.append("")
+        return "\n".join(lines).encode("utf-8")
+
+
+async def monitor_loop_lag(histogram, interval=0.5, recent=None):
+    # 定时器本该在 interval 后触发，实际晚了多少就是事件循环被占住的时间；
+    # recent 是一个带 maxlen 的 deque 时，另外按顺序留下最近的 (时间戳, 延迟)
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        histogram.observe(lag)
+        if recent is not None:
+            recent.append((time.time(), lag))
+
+
+async def serve(registry, host, port, path="/metrics"):
+    """极简的 HTTP/1.0 服务，只回答 GET path，不引入额外依赖。"""
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5.0)
+            parts = request.split(b" ", 2)
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == path.encode():
+                start = time.perf_counter()
+                body = registry.render()
+                body += f"jigger_metrics_render_seconds {time.perf_counter() - start:.6f}\n".encode()
+                status, ctype = b"200 OK", b"text/plain; version=0.0.4; charset=utf-8"
+            else:
+                body, status, ctype = b"not found\n", b"404 Not Found", b"text/plain"
+            writer.write(b"HTTP/1.0 " + status + b"\r\nContent-Type: " + ctype +
+                         b"\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
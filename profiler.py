@@ -0,0 +1,70 @@
+# profiler.py
+# 线上按需采样：在运行中的 server.py 里同时打开 cProfile 和 tracemalloc，跑固定的秒数后写到磁盘，
+# 不用重启进程。由 SIGUSR1 或带管理密钥的 {"type":"profile"} 消息触发（见 server.py）。
+# 每次采样写三个文件，前缀是 <目录>/<名字>-<时间>：
+#   .pstats       python -m pstats 或 snakeviz 打开
+#   .tracemalloc  tracemalloc.Snapshot.load 读回，可以和另一次采样 compare_to
+#   .txt          最耗 CPU 的函数和采样窗口内新分配、仍然存活的内存最多的代码行，直接看
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+
+TOP_N = 30
+
+
+class Profiler:
+    def __init__(self, directory="profiles", name="server", trace_frames=5):
+        self.directory = directory
+        self.name = name
+        self.trace_frames = trace_frames
+        self.running = False
+
+    async def capture(self, seconds, extra=None):
+        """采样 seconds 秒，返回写出的文件路径；已经有一次采样在跑时返回 None。
+
+        extra 是返回 {标题: 文本} 的函数，采样结束时调用，结果附在文字报告后面（例如事件循环延迟）。
+        """
+        if self.running:
+            return None
+        self.running = True
+        try:
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start(self.trace_frames)
+            before = tracemalloc.take_snapshot()
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+                elapsed = time.perf_counter() - start
+                after = tracemalloc.take_snapshot()
+                if started_tracing:
+                    tracemalloc.stop()
+            return self.write(profile, before, after, elapsed, extra() if extra else {})
+        finally:
+            self.running = False
+
+    def write(self, profile, before, after, elapsed, extra):
+        os.makedirs(self.directory, exist_ok=True)
+        prefix = os.path.join(self.directory, f"{self.name}-{time.strftime('%Y%m%d-%H%M%S')}")
+        profile.dump_stats(f"{prefix}.pstats")
+        after.dump(f"{prefix}.tracemalloc")
+        out = io.StringIO()
+        out.write(f"window {elapsed:.2f} s\n\n")
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats("tottime").print_stats(TOP_N)
+        out.write(f"\nallocations made during the window and still alive, top {TOP_N} lines\n")
+        for diff in after.compare_to(before, "lineno")[:TOP_N]:
+            out.write(f"{diff}\n")
+        for title, text in extra.items():
+            out.write(f"\n{title}\n{text}\n")
+        with open(f"{prefix}.txt", "w", encoding="utf-8") as f:
+            f.write(out.getvalue())
+        return [f"{prefix}.pstats", f"{prefix}.tracemalloc", f"{prefix}.txt"]
@@ -0,0 +1,67 @@
+# relay_trace.py
+# 抽样的端到端转发延迟追踪，客户端和服务器共用。
+# 被抽中的 action/chat 帧带一个 "trace" 字段，沿途各处往里记时间戳（time.time()，秒）：
+#   cs  发送方客户端发出       sr  服务器收到
+#   ss  服务器写给接收方       cr  接收方网络线程收到
+#   cp  接收方 process_queue 处理（收到后要等下一次 50 ms 轮询）
+# 跨机器时 uplink/downlink 两段会受时钟偏差影响，server、client_queue 两段只用同一台机器的时钟。
+# 二进制协议的帧不带追踪，抽中的帧总是以 JSON 发送。
+import random
+
+import metrics
+
+TRACE_KEY = b'"trace"'
+
+# 每一段：(名字, 起点, 终点)
+HOPS = (
+    ("uplink", "cs", "sr"),
+    ("server", "sr", "ss"),
+    ("downlink", "ss", "cr"),
+    ("client_queue", "cr", "cp"),
+    ("total", "cs", "cp"),
+)
+BUCKETS = metrics.LATENCY_BUCKETS + (2.5, 5.0)
+
+
+def maybe_start(event, rate, now):
+    """按抽样率给即将发送的消息加上追踪，返回是否抽中。"""
+    if rate and random.random() < rate:
+        event["trace"] = {"cs": now}
+        return True
+    return False
+
+
+class Tracer:
+    """每一段一个延迟直方图；传入 registry 时同时作为 Prometheus 指标导出。"""
+
+    def __init__(self, registry=None, prefix="jigger_trace", hops=None):
+        self.samples = 0
+        self.histograms = {}
+        self.hops = [h for h in HOPS if hops is None or h[0] in hops]
+        for hop, start, end in self.hops:
+            name = f"{prefix}_{hop}_seconds"
+            help = f"Sampled relay latency from {start} to {end}"
+            if registry is not None:
+                self.histograms[hop] = registry.histogram(name, help, BUCKETS)
+            else:
+                self.histograms[hop] = metrics.Histogram(name, help, BUCKETS)
+
+    def observe(self, hop, seconds):
+        # 时钟偏差可能让跨机器的段算出负数，记成 0
+        self.histograms[hop].observe(max(0.0, seconds))
+
+    def record(self, trace):
+        """记录 trace 里两端时间戳都齐了的各段。"""
+        self.samples += 1
+        for hop, start, end in self.hops:
+            if start in trace and end in trace:
+                self.observe(hop, trace[end] - trace[start])
+
+    def summary(self):
+        lines = [f"trace samples: {self.samples}"]
+        for hop, h in self.histograms.items():
+            if h.count:
+                lines.append(f"  {hop:<13} n={h.count:<6} avg={h.sum / h.count * 1000:8.2f} ms  "
+                             f"p50<={h.quantile(0.5) * 1000:g} ms  p95<={h.quantile(0.95) * 1000:g} ms  "
+                             f"p99<={h.quantile(0.99) * 1000:g} ms")
+        return "\n".join(lines)
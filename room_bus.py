@@ -0,0 +1,172 @@
+# room_bus.py
+# 房间广播总线：多个 server.py worker 之间转发 action/chat 帧，让一个房间可以跨进程。
+# 每个 worker 只把消息发布到总线一次，由总线转给订阅了该房间的其他 worker，
+# 各 worker 再在本地扇出给自己的玩家。
+import argparse
+import asyncio
+import struct
+
+# 帧头：操作码、房间名长度、负载长度
+HEADER = struct.Struct("!BHI")
+OP_SUB = 1
+OP_UNSUB = 2
+OP_PUB = 3
+
+KINDS = ("control", "action", "chat")
+
+
+class RoomBus:
+    """总线接口。frame 是已编码好的字节，on_message(room_id, kind, frame) 在收到其他 worker 发布的消息时调用。"""
+
+    async def start(self, on_message):
+        self.on_message = on_message
+
+    def subscribe(self, room_id):
+        raise NotImplementedError
+
+    def unsubscribe(self, room_id):
+        raise NotImplementedError
+
+    def publish(self, room_id, kind, frame):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class LocalHub:
+    def __init__(self):
+        self.subscribers = {}  # room_id -> set of LocalBus
+
+
+class LocalBus(RoomBus):
+    """进程内实现：同一进程里的多个 bus 实例共享一个 hub，用于单进程和测试。"""
+
+    default_hub = LocalHub()
+
+    def __init__(self, hub=None):
+        self.hub = hub or LocalBus.default_hub
+
+    def subscribe(self, room_id):
+        self.hub.subscribers.setdefault(room_id, set()).add(self)
+
+    def unsubscribe(self, room_id):
+        subs = self.hub.subscribers.get(room_id)
+        if subs:
+            subs.discard(self)
+            if not subs:
+                del self.hub.subscribers[room_id]
+
+    def publish(self, room_id, kind, frame):
+        loop = asyncio.get_running_loop()
+        for bus in self.hub.subscribers.get(room_id, ()):
+            if bus is not self:
+                loop.call_soon(bus.on_message, room_id, kind, frame)
+
+
+def pack(op, room_id, payload=b""):
+    room = room_id.encode("utf-8")
+    return HEADER.pack(op, len(room), len(payload)) + room + payload
+
+
+async def read_message(reader):
+    op, room_len, payload_len = HEADER.unpack(await reader.readexactly(HEADER.size))
+    room = (await reader.readexactly(room_len)).decode("utf-8")
+    payload = await reader.readexactly(payload_len) if payload_len else b""
+    return op, room, payload
+
+
+class UnixSocketBus(RoomBus):
+    """连接本机 Unix socket broker（run_broker）的实现，用来代替真正的消息中间件。"""
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+        self.reader_task = None
+
+    async def start(self, on_message):
+        await super().start(on_message)
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.reader_task = asyncio.create_task(self._read_loop(reader))
+
+    async def _read_loop(self, reader):
+        try:
+            while True:
+                op, room_id, payload = await read_message(reader)
+                if op == OP_PUB:
+                    self.on_message(room_id, KINDS[payload[0]], payload[1:])
+        except asyncio.IncompleteReadError:
+            print("Room bus connection closed")
+
+    def subscribe(self, room_id):
+        self.writer.write(pack(OP_SUB, room_id))
+
+    def unsubscribe(self, room_id):
+        self.writer.write(pack(OP_UNSUB, room_id))
+
+    def publish(self, room_id, kind, frame):
+        self.writer.write(pack(OP_PUB, room_id, bytes((KINDS.index(kind),)) + frame))
+
+    async def close(self):
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+def create_bus(spec):
+    # spec: None / "local" / "unix:/path/to/broker.sock"
+    if not spec:
+        return None
+    if spec == "local":
+        return LocalBus()
+    if spec.startswith("unix:"):
+        return UnixSocketBus(spec[len("unix:"):])
+    raise ValueError(f"unknown room bus: {spec}")
+
+
+async def run_broker(path):
+    subscribers = {}  # room_id -> set of StreamWriter
+
+    def unsubscribe(room_id, writer):
+        subs = subscribers.get(room_id)
+        if subs:
+            subs.discard(writer)
+            if not subs:
+                del subscribers[room_id]
+
+    async def serve(reader, writer):
+        rooms = set()
+        try:
+            while True:
+                op, room_id, payload = await read_message(reader)
+                if op == OP_SUB:
+                    subscribers.setdefault(room_id, set()).add(writer)
+                    rooms.add(room_id)
+                elif op == OP_UNSUB:
+                    unsubscribe(room_id, writer)
+                    rooms.discard(room_id)
+                elif op == OP_PUB:
+                    # 原样转发给订阅了该房间的其他 worker，不回发给发布者
+                    data = pack(OP_PUB, room_id, payload)
+                    for w in subscribers.get(room_id, ()):
+                        if w is not writer:
+                            w.write(data)
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            for room_id in rooms:
+                unsubscribe(room_id, writer)
+            writer.close()
+
+    server = await asyncio.start_unix_server(serve, path)
+    print(f"Room bus broker listening at {path}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Unix-socket room bus broker")
+    parser.add_argument("path", nargs="?", default="/tmp/jigger-bus.sock")
+    args = parser.parse_args()
+    asyncio.run(run_broker(args.path))
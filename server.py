@@ -1,46 +1,1365 @@
 import asyncio
+import bisect
+import collections
+import functools
+import heapq
+import os
+import random
+import re
+import secrets
+import signal
+import socket
+import sys
+import time
 import websockets
 import json
 
-rooms = {}  # room_id -> {"password": str, "players": set of websockets}
+import compression
+import metrics
+import relay_trace
+import wire
+from auth import Authenticator, TokenCache
+from profiler import Profiler
+from room_bus import create_bus
+
+# 有 orjson 就用 orjson，解析/编码都快得多；服务器发出的帧统一是 UTF-8 字节
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    loads = orjson.loads
+
+    def dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+else:
+    loads = json.loads
+
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+# 转发快速路径：客户端的 action/chat 帧第一个键就是 type，只嗅探这一段，
+# 不解析整帧也不重新编码，原样转发收到的字节
+FAST_TYPE = re.compile(rb'\s*\{\s*"type"\s*:\s*"(action|chat)"')
+FAST_KINDS = {b"action": "action", b"chat": "chat"}
+
+def fast_kind(msg):
+    # JSON 里重复的键以最后一个为准：后面再藏一个 type（或者用 \u 转义写的 type）的帧，
+    # 接收方解析出来可能是 reconnect/redirect 之类的控制消息，这种帧必须完整解析后再决定转不转发
+    m = FAST_TYPE.match(msg)
+    if m is None or msg.count(b'"type"') != 1 or b"\\u00" in msg:
+        return None
+    return FAST_KINDS[m.group(1)]
+
+# 慢客户端背压策略
+MAX_BACKLOG = 256             # 每个连接允许积压的最大帧数
+BACKLOG_LOW_WATER = 128       # 超限后丢弃动作帧，直到积压降到这个水位
+SLOW_CONSUMER_TIMEOUT = 10.0  # 持续积压超过这么多秒就断开连接
+
+# 动作帧按 tick 合并：0 表示关闭（逐条转发），例如 0.05 表示每 50ms 每个房间发一个 actions 批次
+ACTION_TICK = 0
+
+# 每个玩家每种消息的令牌桶：(每秒补充的令牌数, 桶容量)，None 表示不限。
+# 超限的 action 折叠成一个带 count 的 action 帧，等有令牌时再发；超限的 chat 拒绝并告知发送者
+RATE_LIMITS = {"action": (20.0, 40), "chat": (2.0, 5)}
+
+# 服务器发出的一帧 action（二进制客户端的动作、折叠、按 tick 合并的批次）里每个玩家最多代表这么多次动作，多出来的丢掉
+MAX_ACTION_COUNT = 100
+
+# list_rooms 分页
+ROOM_LIST_PAGE_SIZE = 100
+ROOM_LIST_MAX_PAGE = 500
+
+# 房间回收：最后一个玩家离开（包括等续传的）ROOM_EMPTY_GRACE 秒后删掉房间；
+# 房间总数到 MAX_ROOMS 时先回收最早空出来的房间，没有空房间可回收就拒绝新建（None 不限）
+ROOM_EMPTY_GRACE = 30.0
+MAX_ROOMS = 100000
+
+# permessage-deflate：
+# "selective" 按消息类型和大小决定（见 compression.py），小的 action 帧不压缩；
+# "deflate" 为 websockets 默认行为，每条都压缩；None 完全关闭
+COMPRESSION = "selective"
+
+# 平台认证，和 server10.go 相同的 auth / auth_success 握手。None 表示不要求认证
+AUTH_SERVICE_URL = None  # 例如 "http://localhost:8080/auth"
+AUTH_INTERNAL_KEY = "your_internal_api_key"
+AUTH_TIMEOUT = 10.0        # 连接建立后多久内必须发来 auth 消息
+AUTH_POOL_SIZE = 32        # 到认证服务的最大并发连接数
+AUTH_CACHE_SIZE = 10000    # 缓存的已校验 token 数
+AUTH_CACHE_TTL = 300.0
+
+# 跨进程房间总线：None 关闭；"local" 进程内；"unix:/tmp/jigger-bus.sock" 连接 room_bus.py 启动的 broker
+ROOM_BUS = None
+
+# 指标：Prometheus 文本格式，GET http://METRICS_HOST:METRICS_PORT/metrics；METRICS_PORT 为 None 时不开（默认）。
+# 要开时挑一个本机没人用的端口，例如 9765；别用 9100，那是 node_exporter 的端口，占着的话服务器起不来
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None
+HOT_ROOMS = 10             # 报告流量最大的前几个房间
+HOT_ROOMS_WINDOW = 60.0    # 最热房间按这么长的窗口统计
+LOOP_LAG_INTERVAL = 0.5    # 事件循环延迟采样间隔，不开指标端口也一直采样
+LOOP_LAG_RECENT = 120      # stats 和采样报告里给出最近这么多次的延迟
+ROOM_MEMORY_MAX_AGE = 1.0  # 房间内存报告要遍历所有房间，一次抓取里的两个指标共用，最多这么旧
+
+# 按需采样：kill -USR1 <pid>，或者发 {"type":"profile","key":PROFILE_ADMIN_KEY,"seconds":N}，
+# 在不重启的情况下采 N 秒 cProfile + tracemalloc，写到 PROFILE_DIR（见 profiler.py）。
+# PROFILE_ADMIN_KEY 为 None 时不接受消息触发，只能用信号
+PROFILE_DIR = "profiles"
+PROFILE_SECONDS = 10.0
+PROFILE_MAX_SECONDS = 120.0
+PROFILE_ADMIN_KEY = None
+
+# 事件循环和 socket 参数。装了 uvloop 就用 uvloop（可选依赖，没装照常用 asyncio 默认循环）
+USE_UVLOOP = True
+# 每个档位：rcvbuf/sndbuf 是内核 socket 缓冲区字节数（None 用系统默认），nodelay 控制 Nagle，
+# max_size/max_queue/write_limit 原样传给 websockets.serve（单条消息上限、收包队列、发送缓冲高水位），
+# compression 覆盖 COMPRESSION，deflate_context=False 时压缩上下文不跨消息保留（每条消息用完就释放 zlib 状态），
+# idle_release 为秒数：连接这么久没有要发的帧就释放它的发送队列和 writer 任务，下次有帧时再建
+SOCKET_PROFILES = {
+    "default": {},
+    # 转发小帧为主：关 Nagle、收小发大，单条消息限 64 KB（客户端只发 action/chat/join 这类小帧）
+    "relay": {"nodelay": True, "rcvbuf": 64 * 1024, "sndbuf": 256 * 1024,
+              "max_size": 64 * 1024, "max_queue": 16, "write_limit": 64 * 1024},
+    # 一个进程挂一万个以上大多空闲的宠物客户端：小缓冲、不留压缩上下文、空闲连接释放发送队列
+    "lowmem": {"rcvbuf": 16 * 1024, "sndbuf": 32 * 1024, "max_size": 16 * 1024, "max_queue": 4,
+               "write_limit": 8 * 1024, "deflate_context": False, "idle_release": 30.0},
+}
+SOCKET_PROFILE = "default"
+
+# 平滑重启：收到 SIGTERM/SIGINT 后停止接受新连接，把房间（含密码）和成员写进快照，
+# 通知每个客户端在 DRAIN_RECONNECT_MIN + [0, DRAIN_RECONNECT_JITTER) 秒后重连，错开重连高峰；
+# 启动时读取不超过 SNAPSHOT_MAX_AGE 秒的快照，房间立刻重新出现。SNAPSHOT_PATH 为 None 时不写快照
+SNAPSHOT_PATH = "rooms_snapshot.json"
+SNAPSHOT_MAX_AGE = 300.0
+DRAIN_RECONNECT_MIN = 1.0
+DRAIN_RECONNECT_JITTER = 10.0
+DRAIN_TIMEOUT = 5.0  # 最多等这么久让 reconnect 通知和已排队的帧发出去
+
+# 断线续传：加入房间时发给客户端一个 resume token；断线后 RESUME_GRACE 秒内带着 token 和
+# 最后收到的 seq 重连，就回到原来的房间和短 id，只补发漏掉的消息，不用重新 join。
+# 每个房间最近 REPLAY_BUFFER 条 REPLAY_KINDS 消息带递增的 seq 并留在环形缓冲里
+REPLAY_BUFFER = 256
+REPLAY_KINDS = {"chat"}
+RESUME_GRACE = 60.0
+
+# 每个房间由一个 actor 任务负责扇出：连接只把帧放进房间的收件队列，actor 每轮把队列里现有的帧依次发出，
+# 同一房间内的顺序有保证；每轮最多往发送队列推 ROOM_ACTOR_BUDGET 帧就让出事件循环，热门房间不会拖住冷门房间。
+# 收件队列积压到 ROOM_INBOX_MAX 时，往里发的连接暂停读取，直到降到一半（压力传回发送方的 TCP）。
+# False 时退回到在发送方的 handler 里直接扇出
+ROOM_ACTORS = True
+ROOM_ACTOR_BUDGET = 2000
+ROOM_INBOX_MAX = 512
+
+# 处理客户端抽样发来的带 "trace" 的帧（见 relay_trace.py）；关掉后这些帧按普通帧原样转发
+TRACE_FRAMES = True
+
+class RoomDirectory:
+    """list_rooms 用的房间目录。
+
+    每个房间的 JSON 片段在创建/加入/离开时单独重新序列化，列表请求只做拼接；
+    同一版本下相同的查询直接返回缓存的整帧。客户端带上 version，没有变化时只回 not_modified；
+    version 里带着查询参数，上一页拿到的 version 不会让下一页被当成没变。
+    """
+
+    MAX_CACHED_PAGES = 256
+
+    def __init__(self):
+        self.names = []    # 按名字排序的房间列表，用于分页和前缀过滤
+        self.entries = {}  # room_id -> 预序列化的 {"room", "has_password", "players"}
+        self.epoch = os.urandom(4).hex()  # 区分不同的服务器进程，避免重启后版本号撞上
+        self.version = 0
+        self.pages = {}    # (prefix, offset, limit) -> 当前版本的 room_list 帧
+
+    @property
+    def token(self):
+        return f"{self.epoch}.{self.version}"
+
+    def query_token(self, prefix, offset, limit):
+        return f"{self.token}:{offset}:{limit}:{prefix}"
+
+    def update(self, room_id, room):
+        if room_id not in self.entries:
+            bisect.insort(self.names, room_id)
+        self.entries[room_id] = json.dumps(
+            {"room": room_id, "has_password": bool(room.password), "players": len(room.players)})
+        self._changed()
+
+    def remove(self, room_id):
+        if self.entries.pop(room_id, None) is not None:
+            del self.names[bisect.bisect_left(self.names, room_id)]
+            self._changed()
+
+    def _changed(self):
+        self.version += 1
+        self.pages.clear()
+
+    def page(self, prefix="", offset=0, limit=ROOM_LIST_PAGE_SIZE):
+        key = (prefix, offset, limit)
+        frame = self.pages.get(key)
+        if frame is None:
+            lo = bisect.bisect_left(self.names, prefix)
+            hi = bisect.bisect_left(self.names, prefix + "\U0010ffff") if prefix else len(self.names)
+            names = self.names[lo + offset:min(hi, lo + offset + limit)]
+            frame = ('{"type": "room_list", "version": %s, "total": %d, "offset": %d, "rooms": [%s]}' % (
+                json.dumps(self.query_token(prefix, offset, limit)), hi - lo, offset, ", ".join(self.entries[n] for n in names))).encode("utf-8")
+            if len(self.pages) >= self.MAX_CACHED_PAGES:
+                self.pages.clear()
+            self.pages[key] = frame
+        return frame
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = None
+
+    def _refill(self, now):
+        if self.stamp is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, now):
+        # 距离下一个令牌还要多久
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+class Room:
+    __slots__ = ("password", "players", "binary", "targets", "next_sid", "members",
+                 "seq", "log", "log_bytes", "roster", "roster_version", "inbox", "actor", "wakeup", "space")
+
+    def __init__(self, password, members=()):
+        self.password = password
+        self.players = set()   # 房间里的 websocket
+        self.binary = set()    # 其中走二进制协议的连接
+        self.targets = ()      # 房间里连接的 Player 记录，扇出时直接遍历；只在成员变化时重建
+        self.next_sid = 1      # 下一个短 id
+        self.members = set(members)  # 快照里记录、重启后还没回来的 player_id
+        self.seq = 0           # 最后一条回放消息的序号
+        self.log = collections.deque(maxlen=REPLAY_BUFFER)  # (seq, 发送者 player_id, JSON 帧, 二进制帧)
+        self.log_bytes = 0     # log 里 JSON 帧的总字节数，由 sequence 随增随减（二进制帧要用时才生成，不占地方）
+        self.roster = {}       # player_id -> 短 id（包括断线后还在等续传的玩家）
+        self.roster_version = 0  # 每次增减加一
+        self.inbox = None      # 待扇出的 (frame, kind, exclude, binary, sender)，kind 为 None 时 frame 是要调用的函数；
+                               # 和 actor 一起在第一次有帧时创建
+        self.actor = None
+        self.wakeup = None
+        self.space = None      # 收件队列降下来后叫醒暂停读取的连接
+
+    def add(self, player):
+        # 扇出目标要等 actor 处理到这次加入时才加（见 admit），之前排队的帧不会发给新成员
+        self.players.add(player.ws)
+        if player.binary:
+            self.binary.add(player.ws)
+
+    def admit(self, player):
+        if player.ws in self.players and player not in self.targets:
+            self.targets += (player,)
+
+    def discard(self, ws):
+        self.players.discard(ws)
+        self.binary.discard(ws)
+        self.targets = tuple(p for p in self.targets if p.ws is not ws)
+
+class Player:
+    """一个连接的状态。连接断开后记录就丢掉，断线续传靠 sessions 里的信息接回。"""
+
+    __slots__ = ("ws", "room", "player_id", "sid", "binary", "user", "session", "buckets",
+                 "folded", "fold_timer", "queue", "wakeup", "writer", "active", "over_since", "closed")
+
+    def __init__(self, ws, user=None):
+        self.ws = ws
+        self.room = None
+        self.player_id = id(ws)
+        self.sid = None
+        self.binary = ws.subprotocol == wire.SUBPROTOCOL_BINARY
+        self.user = user
+        self.session = None
+        self.buckets = {}
+        self.folded = 0
+        self.fold_timer = None
+        self.queue = None   # (kind, sender, frame, text) 的 deque；和 wakeup、writer 一起在第一次入队时创建
+        self.wakeup = None
+        self.writer = None
+        self.active = False  # 上次空闲检查以来有没有入过队
+        self.over_since = None
+        self.closed = False  # 已经断开或因为太慢被踢掉，不再入队
+
+rooms = {}  # room_id -> Room
+directory = RoomDirectory()
+conns = {}  # websocket -> Player
+room_stats = collections.defaultdict(
+    lambda: {"dropped": 0, "collapsed": 0, "disconnected": 0, "folded": 0, "rate_limited": 0})
+pending_actions = {}  # room_id -> Counter((player_id, sid) -> 本 tick 内的动作次数)
+compression_totals = {"connections": 0, "messages": 0, "compressed": 0, "bytes_saved": 0, "skipped_bytes": 0, "cpu_ms": 0.0}
+
+idle_rooms = {}  # 空房间 room_id -> 回收定时器，按空出来的先后排列
+sessions = {}  # resume token -> {"room", "player_id", "sid", "user", "ws": 当前连接（断线时为 None）, "timer"}
+
+bus = None  # 由 main 根据 ROOM_BUS 创建
+authenticator = None  # 由 main 根据 AUTH_SERVICE_URL 创建
+
+# 指标；按类型计数时只用已知的消息类型当标签，客户端乱发的 type 归到 "other"
+MESSAGE_TYPES = {"action", "chat", "join", "list_rooms", "stats", "auth", "resume", "roster", "profile"}
+registry = metrics.Registry()
+m_connections = registry.counter("jigger_connections_total", "WebSocket connections accepted")
+m_messages_in = registry.counter("jigger_messages_in_total", "Frames received from clients", "type")
+m_bytes_in = registry.counter("jigger_bytes_in_total", "Bytes received from clients", "type")
+m_messages_out = registry.counter("jigger_messages_out_total", "Frames sent to clients", "kind")
+m_bytes_out = registry.counter("jigger_bytes_out_total", "Bytes sent to clients", "kind")
+m_fanout = registry.histogram("jigger_fanout_seconds", "Time to encode and enqueue one frame for a whole room")
+m_loop_lag = registry.histogram("jigger_event_loop_lag_seconds", "How late a timer fired on the event loop")
+loop_lag_recent = collections.deque(maxlen=LOOP_LAG_RECENT)  # (时间戳, 延迟秒数)；main 按当时的 LOOP_LAG_RECENT 重建
+profiler = None  # 由 main 创建
+profile_task = None  # 正在进行的按需采样
+tracer = relay_trace.Tracer(registry, hops=("uplink", "server"))  # 另外几段由接收方客户端记录
+room_traffic = collections.Counter()  # room_id -> 当前窗口内发出的帧数
+traffic_since = time.monotonic()      # 当前窗口的开始时间
+hot_rooms_last = {}  # 上一个完整窗口的 room_id -> 每秒帧数
+
+def backlog_stats():
+    total = longest = over = 0
+    for conn in conns.values():
+        n = len(conn.queue or ())
+        total += n
+        longest = max(longest, n)
+        over += conn.over_since is not None
+    return {"total": total, "max": longest, "over_limit": over}
+
+def hot_rooms():
+    if hot_rooms_last:
+        top = sorted(hot_rooms_last.items(), key=lambda kv: kv[1], reverse=True)[:HOT_ROOMS]
+    else:
+        # 第一个窗口还没结束，先按目前为止的速率报
+        elapsed = max(time.monotonic() - traffic_since, 1e-3)
+        top = [(r, round(n / elapsed, 3)) for r, n in room_traffic.most_common(HOT_ROOMS)]
+    return dict(top)
+
+registry.gauge("jigger_connections", "Open WebSocket connections", lambda: len(conns))
+registry.gauge("jigger_rooms", "Rooms in this process", lambda: len(rooms))
+registry.gauge("jigger_players", "Players currently in a room",
+               lambda: sum(len(r.players) for r in rooms.values()))
+registry.gauge("jigger_idle_rooms", "Empty rooms waiting to be reclaimed", lambda: len(idle_rooms))
+# 两个房间内存指标共用同一次抓取算出来的报告
+registry.gauge("jigger_room_memory_bytes", "Estimated memory held by rooms",
+               lambda: room_memory_report(ROOM_MEMORY_MAX_AGE)["total"])
+registry.gauge("jigger_largest_room_bytes", "Estimated memory of the largest rooms",
+               lambda: room_memory_report(ROOM_MEMORY_MAX_AGE)["largest"], "room")
+registry.gauge("jigger_backlog_frames", "Outbound frames queued across connections", backlog_stats, "stat")
+registry.gauge("jigger_hot_room_frames_per_second", "Outbound frame rate of the busiest rooms", hot_rooms, "room")
+
+async def metrics_ticker():
+    global room_traffic, hot_rooms_last, traffic_since
+    while True:
+        await asyncio.sleep(HOT_ROOMS_WINDOW)
+        window, room_traffic = room_traffic, collections.Counter()
+        traffic_since = time.monotonic()
+        hot_rooms_last = {r: round(n / HOT_ROOMS_WINDOW, 3) for r, n in window.most_common(HOT_ROOMS)}
+
+def count_in(kind, msg):
+    if not isinstance(kind, str) or kind not in MESSAGE_TYPES:
+        kind = "other"
+    m_messages_in.inc(kind)
+    m_bytes_in.inc(kind, len(msg))
+
+def loop_lag_report():
+    # 单位毫秒；分位数来自进程启动以来的直方图，last/max 来自最近 LOOP_LAG_RECENT 次采样
+    lags = [lag for _, lag in loop_lag_recent]
+    return {"samples": m_loop_lag.count,
+            "p50_ms": round(m_loop_lag.quantile(0.5) * 1000, 3), "p99_ms": round(m_loop_lag.quantile(0.99) * 1000, 3),
+            "last_ms": round(lags[-1] * 1000, 3) if lags else None,
+            "recent_max_ms": round(max(lags) * 1000, 3) if lags else None}
+
+def start_profile(seconds=None, ws=None):
+    """开始一次按需采样，seconds 默认取 PROFILE_SECONDS；已经在采样时返回 False。
+    ws 是发起的管理连接，采完告诉它文件在哪。"""
+    global profile_task
+    # 任务还没开始跑 profiler.running 就还是 False，同一轮里来的第二次触发要靠任务本身判断
+    if profile_task is not None and not profile_task.done():
+        return False
+    profile_task = asyncio.create_task(run_profile(PROFILE_SECONDS if seconds is None else seconds, ws))
+    return True
+
+def profile_extra():
+    # 附在采样报告后面：采样结束时的事件循环延迟，和最近每次采样的原始值
+    samples = "\n".join(f"{t:.3f} {lag:.6f}" for t, lag in loop_lag_recent)
+    return {"event loop lag": json.dumps(loop_lag_report()), "recent lag samples (unix time, seconds)": samples}
+
+async def run_profile(seconds, ws):
+    print(f"Profiling for {seconds} s")
+    files = await profiler.capture(seconds, profile_extra)
+    if files is None:
+        return
+    print(f"Profile written to {', '.join(files)}")
+    if ws is not None:
+        enqueue(ws, dumps({"type":"profile_done","files":files}))
+
+# 多进程分片，由 launcher.py 设置；ring 为 None 时单进程运行，所有房间都在本进程
+ring = None
+worker_id = None
+worker_ports = {}  # worker_id -> 该 worker 的独立端口，用于把客户端重定向到房间所在的 worker
+
+room_memory_last = (0.0, None)  # (算出来的 monotonic 时间, 报告)
+
+def room_memory(room):
+    # 估算一个房间占的内存：容器本身，加上回放缓冲里的帧（通常是大头，用 sequence 维护的累计值，不逐条遍历）。
+    # 连接和玩家对象算在连接头上，这里不重复计算
+    size = sys.getsizeof(room) + sys.getsizeof(room.players) + sys.getsizeof(room.binary) + sys.getsizeof(room.targets)
+    size += sys.getsizeof(room.members) + sys.getsizeof(room.roster) + sys.getsizeof(room.log)
+    return size + len(room.password or "") + room.log_bytes
+
+def room_memory_report(max_age=0.0):
+    # max_age 秒内算过就直接用上次的结果
+    global room_memory_last
+    stamp, report = room_memory_last
+    now = time.monotonic()
+    if report is not None and now - stamp <= max_age:
+        return report
+    sizes = {room_id: room_memory(room) for room_id, room in rooms.items()}
+    largest = heapq.nlargest(HOT_ROOMS, sizes.items(), key=lambda kv: kv[1])
+    report = {"total": sum(sizes.values()), "rooms": len(sizes), "largest": dict(largest)}
+    room_memory_last = (now, report)
+    return report
+
+def enqueue(ws, frame, kind="control", sender=None, text=True):
+    # 只入队不等待，真正的发送由 writer 任务完成
+    # kind: "action" 可以被合并/丢弃，"chat" 和 "control" 始终保留；text=False 表示二进制帧
+    conn = conns.get(ws)
+    if conn is not None:
+        push(conn, frame, kind, sender, text)
+
+def push(conn, frame, kind, sender, text=True):
+    if conn.closed:
+        return
+    q = conn.queue
+    if q is None:
+        q = start_writer(conn)
+    conn.active = True
+    q.append((kind, sender, frame, text))
+    if len(q) > MAX_BACKLOG:
+        shed(conn)
+    conn.wakeup.set()
+
+def start_writer(conn):
+    conn.queue = collections.deque()
+    conn.wakeup = asyncio.Event()
+    conn.writer = asyncio.create_task(writer(conn.ws, conn))
+    return conn.queue
+
+async def release_idle(after):
+    # 两轮检查之间没有入过队的连接，叫醒它的 writer，writer 发现队列空着就把队列、Event 和自己都释放掉
+    while True:
+        await asyncio.sleep(after)
+        for conn in conns.values():
+            if conn.writer is None:
+                continue
+            if conn.active:
+                conn.active = False
+            else:
+                conn.wakeup.set()
+
+def shed(conn):
+    q = conn.queue
+    stats = room_stats[conn.room]
+    if conn.over_since is not None:
+        # 已经处于超限状态：新来的动作帧直接丢弃，并检查是否超时
+        if q[-1][0] == "action":
+            q.pop()
+            stats["dropped"] += 1
+        if asyncio.get_running_loop().time() - conn.over_since > SLOW_CONSUMER_TIMEOUT:
+            stats["disconnected"] += 1
+            q.clear()
+            conn.closed = True
+            conns.pop(conn.ws, None)
+            asyncio.create_task(conn.ws.close(1008, "slow consumer"))
+        return
+    # 第一次越过上限：同一发送者的动作帧只保留最新一条
+    latest = {}
+    for i, (kind, sender, _, _) in enumerate(q):
+        if kind == "action":
+            latest[sender] = i
+    keep = set(latest.values())
+    kept = collections.deque()
+    for i, item in enumerate(q):
+        if item[0] != "action" or i in keep:
+            kept.append(item)
+    stats["collapsed"] += len(q) - len(kept)
+    # 仍然太多就从最旧的动作帧开始丢弃
+    if len(kept) > BACKLOG_LOW_WATER:
+        excess = len(kept) - BACKLOG_LOW_WATER
+        trimmed = collections.deque()
+        for item in kept:
+            if excess and item[0] == "action":
+                excess -= 1
+                stats["dropped"] += 1
+                continue
+            trimmed.append(item)
+        kept = trimmed
+    q.clear()
+    q.extend(kept)
+    if len(q) > BACKLOG_LOW_WATER:
+        # 剩下的都是聊天/控制帧，开始计时，超时仍降不下来就断开
+        conn.over_since = asyncio.get_running_loop().time()
+
+def broadcast(room_id, frame, kind="control", exclude=None, binary=None):
+    # 帧只编码一次，推入同房间每个接收者的发送队列后立即返回，
+    # 慢客户端只会拖慢自己的队列，不会拖慢排在它后面的玩家。
+    # binary 是给二进制协议连接的帧，或者生成它的函数，遇到第一个二进制连接时才编码
+    room = rooms.get(room_id)
+    if room is None:
+        return
+    start = time.perf_counter()
+    targets = room.targets
+    room_traffic[room_id] += len(targets) - (exclude in room.players)
+    for p in targets:
+        if p.ws is exclude:
+            continue
+        if p.binary and binary is not None:
+            if callable(binary):
+                binary = binary()  # 转码失败时为 None，之后的二进制连接和 JSON 连接一样收原帧
+            if binary is not None:
+                push(p, binary, kind, exclude, text=False)
+                continue
+        push(p, frame, kind, exclude)
+    m_fanout.observe(time.perf_counter() - start)
+
+def relay(room_id, frame, kind, exclude=None, binary=None):
+    """本地扇出 + 发布到总线一次，由总线转给其他 worker，而不是每个远端玩家发一次。
+
+    返回 True 表示房间的收件队列已经满了，调用方（发送方的 handler）应该先等 room_space。
+    """
+    if room_id is None:
+        return False
+    # seq 是每个 worker 自己的房间序号，由 actor 加上；发到总线上的是不带 seq 的原帧
+    published = frame if isinstance(frame, bytes) else dumps(frame)
+    sender = None
+    if kind in REPLAY_KINDS and exclude in conns:
+        sender = conns[exclude].player_id
+    full = post(room_id, frame, kind, exclude, binary, sender)
+    if bus is not None:
+        bus.publish(room_id, kind, published)
+    return full
+
+def on_bus_message(room_id, kind, frame):
+    # 其他 worker 转来的帧，发给本进程里该房间的所有玩家；
+    # 远端玩家在本 worker 没有短 id，二进制连接这里收到的也是 JSON 文本帧
+    post(room_id, frame, kind)
+
+def post(room_id, frame, kind="control", exclude=None, binary=None, sender=None):
+    # 交给房间的 actor；关掉 ROOM_ACTORS 时当场扇出
+    room = rooms.get(room_id)
+    if room is None:
+        return False
+    if not ROOM_ACTORS:
+        deliver(room_id, frame, kind, exclude, binary, sender)
+        return False
+    inbox = room.inbox
+    if inbox is None:
+        inbox = start_actor(room_id, room)
+    inbox.append((frame, kind, exclude, binary, sender))
+    room.wakeup.set()
+    return len(inbox) >= ROOM_INBOX_MAX
+
+def deliver(room_id, frame, kind, exclude, binary, sender):
+    if kind is None:
+        frame()  # 排在之前的帧都发完了才做的事，例如新成员的接入（见 enter_room）
+        return
+    if kind in REPLAY_KINDS:
+        frame, binary = sequence(room_id, frame, binary, sender)
+    broadcast(room_id, frame, kind, exclude, binary)
+
+def start_actor(room_id, room):
+    room.inbox = collections.deque()
+    room.wakeup = asyncio.Event()
+    room.space = asyncio.Event()
+    room.actor = asyncio.create_task(room_actor(room_id, room))
+    return room.inbox
+
+async def room_actor(room_id, room):
+    inbox, wakeup, space = room.inbox, room.wakeup, room.space
+    while True:
+        while not inbox:
+            wakeup.clear()
+            await wakeup.wait()
+        # 一轮把积下来的帧依次发掉，推够 ROOM_ACTOR_BUDGET 帧就让其他房间先跑
+        budget = ROOM_ACTOR_BUDGET
+        while inbox and budget > 0:
+            frame, kind, exclude, binary, sender = inbox.popleft()
+            try:
+                deliver(room_id, frame, kind, exclude, binary, sender)
+            except Exception as e:
+                # 一帧出错不能让整个房间停摆
+                print(f"Room {room_id}: dropped a {kind} frame: {e!r}")
+            budget -= len(room.targets) or 1
+        if len(inbox) < ROOM_INBOX_MAX // 2:
+            space.set()
+        await asyncio.sleep(0)
+
+async def room_space(room_id):
+    # 房间收件队列满了：发送方暂停读取，等 actor 把队列降到一半
+    room = rooms.get(room_id)
+    if room is not None and room.inbox is not None and len(room.inbox) >= ROOM_INBOX_MAX // 2:
+        room.space.clear()
+        await room.space.wait()
+
+def sequence(room_id, frame, binary, sender):
+    # 给要回放的帧加上房间内递增的 seq 并记进环形缓冲。JSON 帧不重新编码，直接把 "seq" 插在最后的 } 前面：
+    # 重复的键以最后一个为准，客户端自己在帧里带的 seq 盖不过服务器的（type 仍是第一个键，压缩策略照样认得出来）
+    room = rooms.get(room_id)
+    if room is None or not REPLAY_BUFFER:
+        return frame, binary
+    room.seq += 1
+    seq = room.seq
+    if isinstance(frame, dict):
+        frame["seq"] = seq
+        logged = dumps(frame)
+    else:
+        i = frame.rindex(b"}")
+        frame = logged = b'%s,"seq":%d%s' % (frame[:i], seq, frame[i:])
+    if binary is not None:
+        binary = functools.partial(binary_with_seq, binary, seq)
+    if len(room.log) == room.log.maxlen:
+        room.log_bytes -= len(room.log[0][2])  # 马上要被挤出去的最旧一条
+    room.log.append((seq, sender, logged, binary))
+    room.log_bytes += len(logged)
+    return frame, binary
+
+def binary_with_seq(binary, seq):
+    binary = binary() if callable(binary) else binary
+    return None if binary is None else wire.with_seq(binary, seq)
+
+def leave_room(ws, room_id):
+    room = rooms.get(room_id)
+    if room is None or ws not in room.players:
+        return
+    room.discard(ws)
+    directory.update(room_id, room)
+    if bus is not None and not room.players:
+        bus.unsubscribe(room_id)
+    check_idle(room_id)
+
+def enter_room(ws, conn, room_id, welcome):
+    """加入房间。welcome(room) 在 actor 处理到这里时调用，给新连接发的第一帧（名单快照、续传补发）
+    因此排在加入之前已经进了收件队列的帧后面，又在之后的帧前面，增量的版本号和 seq 都接得上。"""
+    room = rooms[room_id]
+    timer = idle_rooms.pop(room_id, None)
+    if timer is not None:
+        timer.cancel()
+    if bus is not None and not room.players:
+        bus.subscribe(room_id)
+    room.add(conn)
+    directory.update(room_id, room)
+    post(room_id, functools.partial(admit, room_id, conn, welcome), None)
+
+def admit(room_id, conn, welcome):
+    room = rooms.get(room_id)
+    if room is None or conn.room != room_id or conn.ws not in room.players:
+        return  # 还没轮到就已经离开了
+    room.admit(conn)
+    welcome(room)
+
+def welcome_join(conn, reply, room):
+    # 名单在加入时就取好（之后的变化都在队列里排在这后面），seq 要等之前排队的聊天都编完号再取
+    reply["seq"] = room.seq
+    push(conn, dumps(reply), "control", None)
+
+def roster_add(room_id, ws, conn):
+    # 名单变化只给其他人广播一条增量，和 server10.go 的 player_joined 一样；
+    # 同一个 player_id 换了连接重新加入时短 id 会变，同样发 player_joined 让大家更新
+    room = rooms[room_id]
+    pid = conn.player_id
+    room.roster[pid] = conn.sid
+    room.roster_version += 1
+    event = {"type":"player_joined","player_id":pid,"sid":conn.sid,"version":room.roster_version}
+    if conn.user is not None and conn.user.get("username"):
+        event["username"] = conn.user["username"]
+    post(room_id, dumps(event), exclude=ws)
+    if bus is not None:
+        # 其他 worker 上的玩家：短 id 和版本号都是本 worker 的，对他们没有意义，发不带这两项的增量
+        del event["sid"], event["version"]
+        bus.publish(room_id, "control", dumps(event))
+
+def roster_remove(room_id, pid, sid):
+    room = rooms.get(room_id)
+    if room is None or room.roster.get(pid) != sid:
+        return  # 这个玩家已经用新的连接重新加入了
+    del room.roster[pid]
+    room.roster_version += 1
+    post(room_id, dumps({"type":"player_left","player_id":pid,"version":room.roster_version}))
+    if bus is not None:
+        bus.publish(room_id, "control", dumps({"type":"player_left","player_id":pid}))
+    check_idle(room_id)
+
+def check_idle(room_id, grace=None):
+    # 没有连接、也没有等续传的玩家时开始计时，到时仍然没人就回收
+    room = rooms.get(room_id)
+    if room is None or room.players or room.roster or room_id in idle_rooms:
+        return
+    delay = ROOM_EMPTY_GRACE if grace is None else grace
+    idle_rooms[room_id] = asyncio.get_running_loop().call_later(delay, reclaim_room, room_id)
+
+def reclaim_room(room_id):
+    timer = idle_rooms.pop(room_id, None)
+    if timer is not None:
+        timer.cancel()
+    room = rooms.get(room_id)
+    if room is None or room.players or room.roster:
+        return
+    del rooms[room_id]
+    if room.actor is not None:
+        room.actor.cancel()
+    directory.remove(room_id)
+    room_stats.pop(room_id, None)
+    pending_actions.pop(room_id, None)
+
+def make_room_for():
+    """新建房间前检查上限：回收最早空出来的房间腾位置，腾不出来返回 False。"""
+    if MAX_ROOMS is None or len(rooms) < MAX_ROOMS:
+        return True
+    if not idle_rooms:
+        return False
+    reclaim_room(next(iter(idle_rooms)))
+    return True
+
+def roster_snapshot(room_id, conn):
+    # 新加入的玩家拿到的完整名单，只在 join 和客户端发现版本号对不上时才生成。
+    # 开了房间总线时名单和版本号只覆盖本 worker 的玩家，标上 partial：客户端不能按它删掉别的 worker 上的玩家，
+    # 那些玩家的进出靠总线转来的不带版本号的 player_joined/player_left
+    room = rooms[room_id]
+    reply = {"type":"room_players","players":list(room.roster),"version":room.roster_version}
+    if bus is not None:
+        reply["partial"] = True
+    if conn.binary:
+        reply["sid"] = conn.sid
+        reply["sids"] = [[pid, sid] for pid, sid in room.roster.items()]
+    return reply
+
+def leave(ws, conn):
+    # 连接离开当前房间：有会话的等续传宽限期过了再从名单里删
+    room_id = conn.room
+    leave_room(ws, room_id)
+    session = sessions.get(conn.session)
+    if session is not None and session["ws"] is ws:
+        detach_session(ws, conn)
+    else:
+        roster_remove(room_id, conn.player_id, conn.sid)
+
+def open_session(ws, conn):
+    # 每次 join 换一个新 token，旧的作废
+    sessions.pop(conn.session, None)
+    token = conn.session = secrets.token_urlsafe(16)
+    sessions[token] = {"room": conn.room, "player_id": conn.player_id, "sid": conn.sid,
+                       "user": conn.user, "ws": ws, "timer": None}
+    return token
+
+def detach_session(ws, conn):
+    # 连接断了，会话再保留 RESUME_GRACE 秒等客户端回来
+    session = sessions.get(conn.session)
+    if session is None or session["ws"] is not ws:
+        return
+    session["ws"] = None
+    session["timer"] = asyncio.get_running_loop().call_later(RESUME_GRACE, expire_session, conn.session)
+
+def expire_session(token):
+    session = sessions.get(token)
+    if session is not None and session["ws"] is None:
+        del sessions[token]
+        roster_remove(session["room"], session["player_id"], session["sid"])
+
+def resume(ws, conn, data):
+    """按 token 把连接接回原来的房间并补发漏掉的消息；失败时返回原因。"""
+    token = data.get("token")
+    session = sessions.get(token) if isinstance(token, str) else None
+    if session is None:
+        return "unknown_session"
+    if session["user"] is not None and (conn.user is None or conn.user["openid"] != session["user"]["openid"]):
+        return "unknown_session"
+    room = rooms.get(session["room"])
+    if room is None:
+        return "room_gone"
+    last = data.get("last_seq", 0)
+    if not isinstance(last, int) or not 0 <= last <= room.seq:
+        # 比房间里最新的 seq 还大：客户端拿到过伪造的 seq，按它续传什么也补不到
+        return "bad_request"
+    missed = [entry for entry in room.log if entry[0] > last]
+    if last < room.seq and (not missed or missed[0][0] != last + 1):
+        # 漏掉的比缓冲里留着的还多，只能重新 join
+        return "gap"
+    old = session["ws"]
+    if old is not None:
+        # 服务器还没发现旧连接已经断了（半开的 TCP），由新连接接管
+        old_conn = conns.get(old)
+        if old_conn is not None:
+            old_conn.session = None
+            old_conn.room = None
+        leave_room(old, session["room"])
+        asyncio.create_task(old.close(1000, "session resumed"))
+    if session["timer"] is not None:
+        session["timer"].cancel()
+        session["timer"] = None
+    conn.room, conn.player_id, conn.sid, conn.session = session["room"], session["player_id"], session["sid"], token
+    session["ws"] = ws
+    enter_room(ws, conn, session["room"],
+               functools.partial(welcome_resume, conn, last, room.roster_version))
+    return None
+
+def welcome_resume(conn, last, roster_version, room):
+    # 补发在 actor 里做：加入前还在收件队列里的聊天这时才有 seq、才进回放缓冲
+    missed = [entry for entry in room.log if entry[0] > last]
+    if last < room.seq and (not missed or missed[0][0] != last + 1):
+        # 排队期间缓冲被挤掉了一截，客户端收到后会重新 join
+        push(conn, dumps({"type":"resume_failed","reason":"gap"}), "control", None)
+        return
+    # 名单没有变化，客户端手里的就是对的；版本号对不上时客户端再发 roster 要完整名单
+    push(conn, dumps({"type":"resumed","room":conn.room,"seq":room.seq,"replayed":len(missed),
+                      "roster_version":roster_version}), "control", None)
+    for _, sender, frame, binary in missed:
+        if sender == conn.player_id:
+            continue  # 自己发的消息客户端本来就有
+        if conn.binary and binary is not None:
+            binary = binary() if callable(binary) else binary
+        if conn.binary and binary is not None:
+            push(conn, binary, "chat", None, text=False)
+        else:
+            push(conn, frame, "chat", None)
+
+def valid_count(count):
+    return isinstance(count, int) and not isinstance(count, bool) and count >= 1
+
+def json_to_binary(msg, kind, sid):
+    # 快速路径转发的帧没有解析过，count/text 不对就按默认值编码；整帧不是合法 JSON 时返回 None，
+    # broadcast 改给二进制连接发原帧。不能让一帧坏数据在扇出到一半时抛异常
+    try:
+        data = loads(msg)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    if kind == "action":
+        count = data.get("count", 1)
+        return wire.encode_action(sid, min(count, MAX_ACTION_COUNT) if valid_count(count) else 1)
+    text = data.get("text", "")
+    return wire.encode_chat(text if isinstance(text, str) else "", sid)
+
+def binary_for(room_id, msg, kind, sid):
+    # JSON 客户端发来的帧，只有房间里有二进制连接时才需要转码
+    room = rooms.get(room_id)
+    if room is None or not room.binary:
+        return None
+    return functools.partial(json_to_binary, msg, kind, sid)
+
+def handle_binary(ws, conn, msg):
+    # 和 relay 一样，返回 True 表示房间收件队列满了
+    room_id = conn.room
+    if room_id not in rooms:
+        return False
+    try:
+        data = wire.decode(msg, from_server=False)
+    except (ValueError, IndexError):
+        return False  # 截断的 varint、不是 UTF-8 的文字、不认识的类型：丢掉这一帧，连接照常
+    count_in(data["type"], msg)
+    pid, sid = conn.player_id, conn.sid
+    if data["type"] == "action":
+        count = data["count"]
+        if count < 1:
+            return False
+        count = min(count, MAX_ACTION_COUNT)
+        if ACTION_TICK:
+            pending_actions.setdefault(room_id, collections.Counter())[(pid, sid)] += count
+        elif not rate_limited(ws, conn, "action", count):
+            return send_action(ws, conn, count)
+    elif data["type"] == "chat" and not rate_limited(ws, conn, "chat"):
+        text = data["text"]
+        return relay(room_id, dumps({"type":"chat","player_id":pid,"text":text}), "chat",
+                     exclude=ws, binary=wire.encode_chat(text, sid))
+    return False
+
+def relay_traced(ws, conn, msg, kind, data=None):
+    # 抽中追踪的帧：记下服务器收到的时间，帧以 dict 入队，由 writer 写出前记下发送时间再编码
+    if data is None:
+        try:
+            data = loads(msg)
+        except ValueError:
+            return False  # 快速路径只嗅探了开头，整帧不是合法 JSON 就丢掉，和完整解析的路径一样
+    trace = data.get("trace")
+    cs = trace.get("cs") if isinstance(trace, dict) else None
+    if not isinstance(cs, (int, float)):
+        return relay(conn.room, msg, kind, exclude=ws, binary=binary_for(conn.room, msg, kind, conn.sid))
+    # 只保留客户端的发送时间，其余字段由服务器和接收方填
+    trace = data["trace"] = {"cs": cs, "sr": time.time()}
+    tracer.record(trace)
+    return relay(conn.room, data, kind, exclude=ws, binary=binary_for(conn.room, msg, kind, conn.sid))
+
+def send_action(ws, conn, count):
+    # 服务器代发的 action 帧（二进制客户端的动作、折叠后的动作），两种编码各一份
+    event = {"type":"action","player_id":conn.player_id}
+    if count != 1:
+        event["count"] = count
+    return relay(conn.room, dumps(event), "action", exclude=ws, binary=wire.encode_action(conn.sid, count))
+
+def rate_limited(ws, conn, kind, count=1):
+    # 返回 True 表示这条消息超限，已经折叠（action）或拒绝（chat），调用方不要再转发
+    limit = RATE_LIMITS.get(kind)
+    if not limit:
+        return False
+    bucket = conn.buckets.get(kind)
+    if bucket is None:
+        bucket = conn.buckets[kind] = TokenBucket(*limit)
+    loop = asyncio.get_running_loop()
+    now = loop.time()
+    if bucket.take(now):
+        return False
+    stats = room_stats[conn.room]
+    if kind == "action":
+        conn.folded += count
+        stats["folded"] += count
+        if conn.fold_timer is None:
+            conn.fold_timer = loop.call_later(bucket.wait_time(now), flush_folded, ws, conn)
+    else:
+        stats["rate_limited"] += 1
+        enqueue(ws, dumps({"type":"rate_limited","what":kind,"retry_after":round(bucket.wait_time(now), 3)}))
+    return True
+
+def flush_folded(ws, conn):
+    # 令牌补上之后，把这段时间折叠的动作合成一帧发出去
+    conn.fold_timer = None
+    if conns.get(ws) is not conn or not conn.folded:
+        return
+    loop = asyncio.get_running_loop()
+    bucket = conn.buckets["action"]
+    if not bucket.take(loop.time()):
+        conn.fold_timer = loop.call_later(bucket.wait_time(loop.time()), flush_folded, ws, conn)
+        return
+    count, conn.folded = min(conn.folded, MAX_ACTION_COUNT), 0
+    send_action(ws, conn, count)
+
+def flush_actions():
+    # 每个房间每个 tick 只编码、广播一帧：{"type":"actions","actions":[[player_id, count], ...]}
+    # 批次里包含发送者自己的动作，由客户端按 player_id 过滤
+    global pending_actions
+    batches, pending_actions = pending_actions, {}
+    for room_id, counts in batches.items():
+        counts = {key: min(n, MAX_ACTION_COUNT) for key, n in counts.items()}
+        frame = dumps({"type":"actions","actions":[[pid, n] for (pid, _), n in counts.items()]})
+        binary = functools.partial(wire.encode_actions, [(sid, n) for (_, sid), n in counts.items()])
+        relay(room_id, frame, "action", binary=binary)
+
+async def action_ticker():
+    while True:
+        await asyncio.sleep(ACTION_TICK)
+        flush_actions()
+
+async def writer(ws, conn):
+    q = conn.queue
+    wakeup = conn.wakeup
+    try:
+        while True:
+            while not q:
+                if not conn.active:
+                    # 空闲了一整轮（只有打开 idle_release 才会走到这里）
+                    conn.queue = conn.wakeup = conn.writer = None
+                    return
+                wakeup.clear()
+                await wakeup.wait()
+            kind, _, frame, text = q.popleft()
+            if conn.over_since is not None and len(q) <= BACKLOG_LOW_WATER:
+                conn.over_since = None
+            if type(frame) is dict:
+                # 带追踪的帧，同一个 dict 被房间里每个接收者共用，各自写出时刻不同
+                trace = frame["trace"]
+                trace["ss"] = time.time()
+                tracer.observe("server", trace["ss"] - trace["sr"])
+                frame = dumps(frame)
+            await ws.send(frame, text=text)
+            m_messages_out.inc(kind)
+            m_bytes_out.inc(kind, len(frame))
+    except websockets.ConnectionClosed:
+        pass
+
+def add_compression_stats(ws):
+    stats = compression.connection_stats(ws)
+    if stats is None:
+        return
+    compression_totals["connections"] += 1
+    for key, value in stats.as_dict().items():
+        compression_totals[key] += value
+
+def compression_report(ws):
+    # 已关闭连接的累计值，加上当前连接自己的数字；按连接平均才好和每连接的 zlib 内存比较
+    total = dict(compression_totals)
+    n = total["connections"]
+    report = {"closed_connections": total, "per_connection": {}, "this_connection": None}
+    if n:
+        report["per_connection"] = {k: round(v / n, 3) for k, v in total.items() if k != "connections"}
+    stats = compression.connection_stats(ws)
+    if stats is not None:
+        report["this_connection"] = stats.as_dict()
+    return report
+
+async def frames(ws):
+    # 文本帧不做 UTF-8 解码，直接拿原始字节（需要 websockets >= 14）
+    try:
+        while True:
+            yield await ws.recv(decode=False)
+    except websockets.ConnectionClosed:
+        # 客户端异常断开（超时放弃、进程被杀）也是正常结束，不要每个连接打一份堆栈
+        pass
+
+async def authenticate(ws):
+    # 第一条消息必须是 {"type":"auth","token","openid"}，通过后返回认证服务给出的用户信息
+    try:
+        data = loads(await asyncio.wait_for(ws.recv(decode=False), AUTH_TIMEOUT))
+    except (asyncio.TimeoutError, ValueError):
+        data = {}
+    if not isinstance(data, dict) or data.get("type") != "auth":
+        await ws.send(dumps({"type":"auth_failed","reason":"auth_required"}), text=True)
+        return None
+    user = await authenticator.verify(data.get("token"), data.get("openid"))
+    if user is None:
+        await ws.send(dumps({"type":"auth_failed","reason":"invalid_token"}), text=True)
+        return None
+    await ws.send(dumps({"type":"auth_success"}), text=True)
+    return user
 
 async def handler(ws):
+    user = None
+    if authenticator is not None:
+        try:
+            user = await authenticate(ws)
+        except websockets.ConnectionClosed:
+            return
+        if user is None:
+            return
     player_room = None
-    player_id = id(ws)
+    conn = Player(ws, user)
+    conns[ws] = conn
+    m_connections.inc()
+    tune_connection(ws)
     try:
-        async for msg in ws:
-            data = json.loads(msg)
+        async for msg in frames(ws):
+            if conn.binary and wire.is_binary_frame(msg):
+                if handle_binary(ws, conn, msg):
+                    await room_space(conn.room)
+                continue
+            kind = fast_kind(msg)
+            if kind is not None and not (ACTION_TICK and kind == "action"):
+                # 广播给同房间其他玩家
+                count_in(kind, msg)
+                if rate_limited(ws, conn, kind):
+                    continue
+                if TRACE_FRAMES and relay_trace.TRACE_KEY in msg:
+                    full = relay_traced(ws, conn, msg, kind)
+                else:
+                    full = relay(player_room, msg, kind, exclude=ws, binary=binary_for(player_room, msg, kind, conn.sid))
+                if full:
+                    await room_space(player_room)
+                continue
+            try:
+                data = loads(msg)
+            except ValueError:
+                data = None
+            if not isinstance(data, dict) or "type" not in data:
+                count_in(None, msg)
+                continue  # 不是 JSON 对象、或者没有 type 的帧丢掉
+            count_in(data.get("type"), msg)
             if data["type"] == "list_rooms":
-                room_list = [{"room": r, "has_password": bool(info.get("password"))} for r, info in rooms.items()]
-                await ws.send(json.dumps({"type":"room_list", "rooms": room_list}))
+                # 可选参数：offset/limit 分页，prefix 按房间名前缀过滤，version 为上次同一查询拿到的版本
+                try:
+                    offset = max(0, int(data.get("offset", 0)))
+                    limit = min(max(1, int(data.get("limit", ROOM_LIST_PAGE_SIZE))), ROOM_LIST_MAX_PAGE)
+                except (TypeError, ValueError, OverflowError):
+                    enqueue(ws, dumps({"type":"list_rooms_failed","reason":"bad_request"}))
+                    continue
+                prefix = str(data.get("prefix", ""))
+                version = directory.query_token(prefix, offset, limit)
+                if data.get("version") == version:
+                    enqueue(ws, dumps({"type":"room_list","version":version,"not_modified":True}))
+                    continue
+                enqueue(ws, directory.page(prefix, offset, limit))
             elif data["type"] == "join":
-                room_id = data["room"]
+                room_id = data.get("room")
                 password = data.get("password")
+                # player_id 要能当名单的键、能原样写进快照，只接受字符串和整数
+                pid = data.get("player_id", id(ws))
+                if not isinstance(room_id, str) or not isinstance(pid, (int, str)) or isinstance(pid, bool):
+                    enqueue(ws, dumps({"type":"join_failed","reason":"bad request"}))
+                    continue
+                if ring is not None and ring.node_for(room_id) != worker_id:
+                    # 房间归另一个 worker 管，让客户端改连那个 worker 的独立端口
+                    port = worker_ports[ring.node_for(room_id)]
+                    enqueue(ws, dumps({"type":"redirect","room":room_id,"port":port}))
+                    continue
                 # 如果房间不存在，创建房间
                 if room_id not in rooms:
-                    rooms[room_id] = {"password": password, "players": set()}
-                else:
-                    # 检查密码
-                    if rooms[room_id].get("password") and rooms[room_id]["password"] != password:
-                        await ws.send(json.dumps({"type":"join_failed","reason":"wrong password"}))
+                    if not make_room_for():
+                        enqueue(ws, dumps({"type":"join_failed","reason":"too many rooms"}))
                         continue
+                    rooms[room_id] = Room(password)
+                else:
+                    # 检查密码；重启前就在房间里的已认证玩家回来时不用再输密码
+                    if rooms[room_id].password and rooms[room_id].password != password:
+                        if user is None or user["openid"] not in rooms[room_id].members:
+                            enqueue(ws, dumps({"type":"join_failed","reason":"wrong password"}))
+                            continue
+                if conn.room is not None:
+                    # 换房间：先正常离开原来的房间
+                    sessions.pop(conn.session, None)
+                    conn.session = None
+                    leave(ws, conn)
+                room = rooms[room_id]
                 player_room = room_id
-                rooms[room_id]["players"].add(ws)
-                # 发送当前房间玩家列表
-                players = [id(p) for p in rooms[room_id]["players"]]
-                await ws.send(json.dumps({"type":"room_players","players":players}))
+                conn.room = room_id
+                # 认证过的连接用 openid 当 player_id（和 server10.go 一样）；
+                # 否则客户端可以在 join 里带上自己的 player_id，不带则沿用连接 id
+                if user is not None:
+                    conn.player_id = user["openid"]
+                else:
+                    conn.player_id = pid
+                room.members.discard(conn.player_id)
+                conn.sid = room.next_sid
+                room.next_sid += 1
+                roster_add(room_id, ws, conn)
+                # 发送当前房间玩家列表；二进制连接额外拿到 player_id -> 短 id 的对应关系。
+                # resume 和 seq 用于断线后续传
+                reply = roster_snapshot(room_id, conn)
+                reply["resume"] = open_session(ws, conn)
+                enter_room(ws, conn, room_id, functools.partial(welcome_join, conn, reply))
+            elif data["type"] == "auth":
+                # 不要求认证时照样回 auth_success，总是先发 auth 的客户端（client10.py）不用区分服务器配置；
+                # 要求认证时 auth 只能是第一条消息，已经在 authenticate 里处理过了
+                if authenticator is None:
+                    enqueue(ws, dumps({"type":"auth_success"}))
+            elif data["type"] == "roster":
+                if player_room in rooms:
+                    # 和增量走同一个队列，快照之前的增量先到，之后的接在快照的版本号后面
+                    frame = dumps(roster_snapshot(player_room, conn))
+                    post(player_room, functools.partial(push, conn, frame, "control", None), None)
+            elif data["type"] == "resume":
+                reason = "already_joined" if player_room is not None else resume(ws, conn, data)
+                if reason:
+                    enqueue(ws, dumps({"type":"resume_failed","reason":reason}))
+                else:
+                    player_room = conn.room
+            elif data["type"] in ("action","chat") and not valid_count(data.get("count", 1)):
+                continue
+            elif data["type"] == "action" and ACTION_TICK:
+                if player_room in rooms:
+                    counts = pending_actions.setdefault(player_room, collections.Counter())
+                    # 和 handle_binary 一样记在连接自己的 player_id 名下，不能替别人报动作
+                    counts[(conn.player_id, conn.sid)] += data.get("count", 1)
             elif data["type"] in ("action","chat"):
-                # 广播给同房间其他玩家
-                for p in rooms.get(player_room, {}).get("players", set()):
-                    if p != ws:
-                        await p.send(msg)
+                # type 不是第一个键、或者有不止一个 type 的帧走不了快速路径，解析出来确实是 action/chat 才原样转发
+                kind = data["type"]
+                if rate_limited(ws, conn, kind, data.get("count", 1)):
+                    continue
+                if TRACE_FRAMES and "trace" in data:
+                    full = relay_traced(ws, conn, msg, kind, data)
+                else:
+                    full = relay(player_room, msg, kind, exclude=ws, binary=binary_for(player_room, msg, kind, conn.sid))
+                if full:
+                    await room_space(player_room)
+            elif data["type"] == "stats":
+                # 每个房间因背压丢弃/合并的帧数、压缩省下的字节和花掉的 CPU，用于线上调参。
+                # 房间内存要遍历所有房间，只在 /metrics 里给，不让任意客户端反复触发
+                enqueue(ws, dumps({"type":"stats","rooms":room_stats,"compression":compression_report(ws),
+                                   "loop_lag":loop_lag_report()}))
+            elif data["type"] == "profile":
+                key = data.get("key")
+                if not PROFILE_ADMIN_KEY or not isinstance(key, str) or not secrets.compare_digest(key, PROFILE_ADMIN_KEY):
+                    enqueue(ws, dumps({"type":"profile_failed","reason":"forbidden"}))
+                    continue
+                try:
+                    seconds = min(max(float(data.get("seconds", PROFILE_SECONDS)), 0.1), PROFILE_MAX_SECONDS)
+                except (TypeError, ValueError):
+                    seconds = PROFILE_SECONDS
+                if start_profile(seconds, ws):
+                    enqueue(ws, dumps({"type":"profile_started","seconds":seconds}))
+                else:
+                    enqueue(ws, dumps({"type":"profile_failed","reason":"busy"}))
     finally:
-        if player_room and ws in rooms.get(player_room, {}).get("players", set()):
-            rooms[player_room]["players"].remove(ws)
+        # 先把连接自己的东西收掉，离开房间时再出什么错也不会把 Player 和 writer 留在 conns 里
+        conn.closed = True
+        conns.pop(ws, None)
+        if conn.writer is not None:
+            conn.writer.cancel()
+        if conn.fold_timer is not None:
+            conn.fold_timer.cancel()
+        add_compression_stats(ws)
+        if conn.room is not None:
+            leave(ws, conn)
+
+def select_subprotocol(connection, subprotocols):
+    # 按服务器的偏好选子协议；老客户端不带子协议时照常接受，按 JSON 处理
+    for p in wire.SUBPROTOCOLS:
+        if p in subprotocols:
+            return p
+    return None
+
+def save_snapshot(path):
+    # 先写临时文件再改名，半截的快照不会被读到；里面有房间密码，只给属主读写
+    snapshot = {"saved_at": time.time(), "rooms": {}}
+    for room_id, room in rooms.items():
+        snapshot["rooms"][room_id] = {"password": room.password,
+                                      "members": list(room.roster) + list(room.members)}
+    tmp = f"{path}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(dumps(snapshot))
+    os.replace(tmp, path)
+    return len(snapshot["rooms"])
+
+def load_snapshot(path):
+    try:
+        with open(path, "rb") as f:
+            snapshot = loads(f.read())
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable room snapshot {path}: {e}")
+        return 0
+    # 读过就删掉，以后崩溃重启时不会把早已过时的房间又翻出来
+    os.remove(path)
+    if time.time() - snapshot.get("saved_at", 0) > SNAPSHOT_MAX_AGE:
+        return 0
+    for room_id, saved in snapshot["rooms"].items():
+        if room_id in rooms:
+            continue
+        rooms[room_id] = Room(saved["password"], saved["members"])
+        directory.update(room_id, rooms[room_id])
+        # 给客户端按 reconnect 通知错开重连留够时间，没人回来的房间照常回收
+        check_idle(room_id, ROOM_EMPTY_GRACE + DRAIN_RECONNECT_MIN + DRAIN_RECONNECT_JITTER)
+    return len(snapshot["rooms"])
+
+async def drain(servers):
+    # 停止接受新连接，但已有连接先留着，发完 reconnect 通知再关
+    for ws_server in servers:
+        ws_server.close(close_connections=False)
+    if SNAPSHOT_PATH:
+        print(f"Saved {save_snapshot(SNAPSHOT_PATH)} rooms to {SNAPSHOT_PATH}")
+    for ws in list(conns):
+        after = DRAIN_RECONNECT_MIN + random.uniform(0, DRAIN_RECONNECT_JITTER)
+        enqueue(ws, dumps({"type":"reconnect","after":round(after, 3)}))
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + DRAIN_TIMEOUT
+    while (any(c.queue for c in conns.values()) or any(r.inbox for r in rooms.values())) \
+            and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+    await asyncio.gather(*(ws.close(1001, "server restarting") for ws in list(conns)), return_exceptions=True)
+    for ws_server in servers:
+        await ws_server.wait_closed()
+    if bus is not None:
+        await bus.close()
+    if authenticator is not None:
+        await authenticator.close()
+
+def socket_profile():
+    return SOCKET_PROFILES[SOCKET_PROFILE]
+
+def tune_listener(ws_server):
+    # 监听 socket 上设的缓冲区大小会被 accept 出来的连接继承
+    profile = socket_profile()
+    for sock in ws_server.sockets:
+        if profile.get("rcvbuf"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, profile["rcvbuf"])
+        if profile.get("sndbuf"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, profile["sndbuf"])
+
+def tune_connection(ws):
+    # asyncio 和 uvloop 建连接时都会自己打开 TCP_NODELAY，要关掉 Nagle 以外的设置只能逐个连接改
+    nodelay = socket_profile().get("nodelay")
+    if nodelay is None:
+        return
+    sock = ws.transport.get_extra_info("socket")
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+
+def install_event_loop():
+    """按 USE_UVLOOP 设置事件循环策略，返回实际使用的事件循环名字。在 asyncio.run 之前调用。"""
+    if USE_UVLOOP:
+        try:
+            import uvloop
+        except ImportError:
+            pass
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return "uvloop"
+    asyncio.set_event_loop_policy(None)
+    return "asyncio"
+
+def serve_options():
+    # 两个监听端口共用的 websockets.serve 参数
+    options = {"subprotocols": wire.SUBPROTOCOLS, "select_subprotocol": select_subprotocol}
+    for key in ("max_size", "max_queue", "write_limit"):
+        if key in socket_profile():
+            options[key] = socket_profile()[key]
+    mode = socket_profile().get("compression", COMPRESSION)
+    if mode == "selective":
+        options["compression"] = None
+        options["extensions"] = compression.server_extensions(
+            context_takeover=socket_profile().get("deflate_context", True))
+    else:
+        options["compression"] = mode
+    return options
 
-async def main():
-    async with websockets.serve(handler, "0.0.0.0", 8765):
-        print("Server started at ws://0.0.0.0:8765")
-        await asyncio.Future()
+async def main(host="0.0.0.0", port=8765, reuse_port=False, private_port=None):
+    global bus, authenticator, profiler, loop_lag_recent
+    if AUTH_SERVICE_URL:
+        authenticator = Authenticator(AUTH_SERVICE_URL, AUTH_INTERNAL_KEY, pool_size=AUTH_POOL_SIZE,
+                                      cache=TokenCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL))
+    bus = create_bus(ROOM_BUS)
+    if bus is not None:
+        await bus.start(on_bus_message)
+    if ACTION_TICK:
+        asyncio.create_task(action_ticker())
+    if socket_profile().get("idle_release"):
+        asyncio.create_task(release_idle(socket_profile()["idle_release"]))
+    loop_lag_recent = collections.deque(maxlen=LOOP_LAG_RECENT)
+    asyncio.create_task(metrics.monitor_loop_lag(m_loop_lag, LOOP_LAG_INTERVAL, loop_lag_recent))
+    profiler = Profiler(PROFILE_DIR, "server" if worker_id is None else f"worker{worker_id}")
+    if METRICS_PORT is not None:
+        await metrics.serve(registry, METRICS_HOST, METRICS_PORT)
+        asyncio.create_task(metrics_ticker())
+        print(f"Metrics at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    if SNAPSHOT_PATH:
+        restored = load_snapshot(SNAPSHOT_PATH)
+        if restored:
+            print(f"Restored {restored} rooms from {SNAPSHOT_PATH}")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows 的事件循环不支持，只能直接退出
+    if hasattr(signal, "SIGUSR1"):
+        try:
+            loop.add_signal_handler(signal.SIGUSR1, start_profile)
+        except (NotImplementedError, RuntimeError):
+            pass
+    servers = []
+    if private_port is not None:
+        servers.append(await websockets.serve(handler, host, private_port, **serve_options()))
+        tune_listener(servers[-1])
+        print(f"Worker {worker_id} listening at ws://{host}:{private_port}")
+    if port is not None:
+        servers.append(await websockets.serve(handler, host, port, reuse_port=reuse_port, **serve_options()))
+        tune_listener(servers[-1])
+        print(f"Server started at ws://{host}:{port} ({type(loop).__module__} loop, "
+              f"{SOCKET_PROFILE} socket profile)")
+    await stop.wait()
+    print("Draining connections")
+    await drain(servers)
 
-asyncio.run(main())
+if __name__ == "__main__":
+    install_event_loop()
+    asyncio.run(main())
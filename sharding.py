@@ -0,0 +1,40 @@
+# sharding.py
+import bisect
+import hashlib
+
+
+def _hash(key):
+    # 不能用内置 hash()：它在每个进程里带随机盐，各 worker 算出来的结果会不一致
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """一致性哈希环：把房间名稳定地映射到某一个 worker。
+
+    每个节点在环上放 replicas 个虚拟节点，增减 worker 时只有少量房间换归属。
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.replicas = replicas
+        self._keys = []
+        self._nodes = {}
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            h = _hash(f"{node}#{i}")
+            self._nodes[h] = node
+            bisect.insort(self._keys, h)
+
+    def remove(self, node):
+        for i in range(self.replicas):
+            h = _hash(f"{node}#{i}")
+            del self._nodes[h]
+            self._keys.remove(h)
+
+    def node_for(self, key):
+        if not self._keys:
+            raise LookupError("hash ring is empty")
+        i = bisect.bisect(self._keys, _hash(str(key))) % len(self._keys)
+        return self._nodes[self._keys[i]]
@@ -0,0 +1,84 @@
+# stub_auth_server.py
+# 本地假认证服务，实现平台 /auth/check-token 接口，方便不接真实平台时测试 server.py 的认证。
+# 形如 "token-<openid>" 的 token 都算有效，openid 就是 token 去掉前缀的部分。
+# GET /auth/stats 返回收到的校验请求数，可以用来确认 server.py 的缓存是否生效。
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOKEN_PREFIX = "token-"
+INTERNAL_KEY = "your_internal_api_key"
+
+
+class StubAuthHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 支持 keep-alive，服务器的连接池才能复用连接
+    requests = 0
+    lock = threading.Lock()
+    delay = 0.0
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/auth/stats":
+            self._reply(200, {"requests": StubAuthHandler.requests})
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if self.path != "/auth/check-token":
+            self._reply(404, {"error": "not found"})
+            return
+        if self.headers.get("X-Internal-Auth") != INTERNAL_KEY:
+            self._reply(403, {"error": "forbidden"})
+            return
+        with StubAuthHandler.lock:
+            StubAuthHandler.requests += 1
+        if StubAuthHandler.delay:
+            time.sleep(StubAuthHandler.delay)
+        token = body.get("token", "")
+        if not token.startswith(TOKEN_PREFIX):
+            self._reply(200, {"valid": False})
+            return
+        openid = token[len(TOKEN_PREFIX):]
+        now = int(time.time())
+        self._reply(200, {
+            "valid": True,
+            "openid": openid,
+            "user_id": abs(hash(openid)) % 100000,
+            "app_id": body.get("app_id"),
+            "username": f"user_{openid}",
+            "session_id": f"session_{openid}",
+            "exp": now + 3600,
+            "iat": now,
+            "jti": f"jti_{openid}_{now}",
+        })
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub of the platform auth service for local tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before answering each check")
+    args = parser.parse_args()
+
+    StubAuthHandler.delay = args.delay
+    server = ThreadingHTTPServer((args.host, args.port), StubAuthHandler)
+    print(f"Stub auth service at http://{args.host}:{args.port}/auth")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,379 @@
-# test_connection.py
+# test_connect.py
+# 负载生成器：在本机启动 server.py，模拟成千上万个客户端按 join -> action/chat 的协议收发，
+# 报告吞吐、投递延迟（发送方写入的时间戳到接收方收到）的 p50/p95/p99 和服务器内存。
+# 例：python test_connect.py --clients 2000 --room-sizes 2:0.5,10:0.3,50:0.2 --slow-share 0.05
+import argparse
+import ast
 import asyncio
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+
 import websockets
 
-async def test_connection():
+import metrics
+
+# 延迟分桶：0.1 ms 到 ~20 s，每格放大 10%，分位数误差在 10% 以内
+DELAY_BUCKETS = tuple(0.0001 * 1.1 ** i for i in range(130))
+
+
+class JoinFailed(Exception):
+    """服务器回了 join_failed 或 redirect（--server 指向 launcher 的端口时房间可能在别的 worker 上）。"""
+
+
+async def wait_for_room_players(ws):
+    # join 之后等 room_players；服务器明确拒绝时不能一直等下去
+    while True:
+        reply = json.loads(await ws.recv())
+        if reply["type"] == "room_players":
+            return reply
+        if reply["type"] in ("join_failed", "redirect"):
+            raise JoinFailed(json.dumps(reply))
+
+
+def parse_room_sizes(spec):
+    # "2:0.5,10:0.3,50:0.2" -> [(2, 0.5), (10, 0.3), (50, 0.2)]，权重是按玩家数算的占比
+    sizes = []
+    for part in spec.split(","):
+        size, _, weight = part.partition(":")
+        sizes.append((int(size), float(weight or 1)))
+    return sizes
+
+
+def plan_rooms(clients, sizes, seed=0):
+    """按权重把 clients 个玩家分进房间，返回每个房间的人数。"""
+    rng = random.Random(seed)
+    total = sum(w for _, w in sizes)
+    plan = []
+    left = clients
+    while left > 0:
+        r = rng.random() * total
+        for size, weight in sizes:
+            r -= weight
+            if r <= 0:
+                break
+        size = min(size, left)
+        plan.append(size)
+        left -= size
+    return plan
+
+
+def rss_kb(pid):
+    # 服务器进程的常驻内存，只支持 Linux 的 /proc
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def cpu_seconds(pid):
+    # 服务器进程累计用掉的 CPU 时间（用户态 + 内核态），同样只支持 Linux
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+class Stats:
+    def __init__(self):
+        self.sent = {"action": 0, "chat": 0}
+        self.received = {"action": 0, "chat": 0, "other": 0}
+        self.delay = metrics.Histogram("delay", "delivery delay", DELAY_BUCKETS)
+        self.slow_delay = metrics.Histogram("slow_delay", "delivery delay to slow consumers", DELAY_BUCKETS)
+        self.rate_limited = 0
+        self.disconnected = 0
+        self.failed = 0
+
+    def as_dict(self):
+        return {
+            "sent": self.sent, "received": self.received,
+            "delay": self.delay.counts, "slow_delay": self.slow_delay.counts,
+            "rate_limited": self.rate_limited, "disconnected": self.disconnected, "failed": self.failed,
+        }
+
+
+class Client:
+    def __init__(self, uri, room, player_id, slow_delay, stats):
+        self.uri = uri
+        self.room = room
+        self.player_id = player_id
+        self.slow_delay = slow_delay
+        self.stats = stats
+        self.ws = None
+
+    async def join(self):
+        # 压测时客户端自己也很忙，关掉心跳避免把 ping 超时算进结果
+        self.ws = await websockets.connect(self.uri, ping_interval=None, close_timeout=1, max_queue=None)
+        await self.ws.send(json.dumps({"type": "join", "room": self.room, "player_id": self.player_id}))
+        try:
+            await wait_for_room_players(self.ws)
+        except JoinFailed:
+            await self.ws.close()
+            raise
+
+    async def send_loop(self, kind, rate, stop):
+        if not rate:
+            return
+        rng = random.Random(self.player_id)
+        try:
+            while True:
+                # 泊松到达，客户端之间不会齐步发送
+                try:
+                    await asyncio.wait_for(stop.wait(), rng.expovariate(rate))
+                    return
+                except asyncio.TimeoutError:
+                    pass
+                if kind == "action":
+                    frame = {"type": "action", "player_id": self.player_id, "ts": time.time()}
+                else:
+                    frame = {"type": "chat", "player_id": self.player_id, "text": "hello " * 8, "ts": time.time()}
+                await self.ws.send(json.dumps(frame))
+                self.stats.sent[kind] += 1
+        except websockets.ConnectionClosed:
+            pass
+
+    async def recv_loop(self):
+        stats = self.stats
+        delay = stats.slow_delay if self.slow_delay else stats.delay
+        try:
+            async for msg in self.ws:
+                now = time.time()
+                event = json.loads(msg)
+                kind = event.get("type")
+                if kind in ("action", "chat"):
+                    stats.received[kind] += 1
+                    if "ts" in event:
+                        delay.observe(now - event["ts"])
+                elif kind == "rate_limited":
+                    stats.rate_limited += 1
+                else:
+                    stats.received["other"] += 1
+                if self.slow_delay:
+                    await asyncio.sleep(self.slow_delay)
+        except websockets.ConnectionClosed as e:
+            if e.rcvd is not None and e.rcvd.code == 1008:
+                stats.disconnected += 1
+
+
+async def run_clients(uri, rooms, args, ready, start):
+    stats = Stats()
+    rng = random.Random(os.getpid())
+    clients = []
+    for room, size in rooms:
+        for i in range(size):
+            slow = args.slow_delay if rng.random() < args.slow_share else 0.0
+            clients.append(Client(uri, room, f"{room}-{i}", slow, stats))
+
+    sem = asyncio.Semaphore(args.connect_concurrency)
+
+    async def join(c):
+        async with sem:
+            try:
+                await c.join()
+            except (OSError, websockets.WebSocketException, asyncio.TimeoutError, JoinFailed):
+                stats.failed += 1
+                c.ws = None
+
+    await asyncio.gather(*(join(c) for c in clients))
+    clients = [c for c in clients if c.ws is not None]
+    ready.set()
+    # 等所有客户端进程都连好再一起开始发
+    await asyncio.get_running_loop().run_in_executor(None, start.wait)
+
+    stop = asyncio.Event()
+    receivers = [asyncio.create_task(c.recv_loop()) for c in clients]
+    senders = [asyncio.create_task(c.send_loop("action", args.action_rate, stop)) for c in clients]
+    senders += [asyncio.create_task(c.send_loop("chat", args.chat_rate, stop)) for c in clients]
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.gather(*senders)
+    await asyncio.sleep(args.drain)
+    for t in receivers:
+        t.cancel()
+    await asyncio.gather(*(c.ws.close() for c in clients), return_exceptions=True)
+    return stats.as_dict()
+
+
+def client_proc(uri, rooms, args, ready, start, results):
+    results.put(asyncio.run(run_clients(uri, rooms, args, ready, start)))
+
+
+def merge(results):
+    total = Stats()
+    for r in results:
+        for key in ("sent", "received"):
+            for kind, n in r[key].items():
+                getattr(total, key)[kind] += n
+        for name in ("delay", "slow_delay"):
+            h = getattr(total, name)
+            for i, n in enumerate(r[name]):
+                h.counts[i] += n
+                h.count += n
+        total.rate_limited += r["rate_limited"]
+        total.disconnected += r["disconnected"]
+        total.failed += r["failed"]
+    return total
+
+
+def start_server(args):
+    # 在子进程里跑 server.py 的 main，--server-opt 可以覆盖模块里的配置常量，例如 ACTION_TICK=0.05
+    setup = ["import asyncio, server", "server.METRICS_PORT = None", "server.SNAPSHOT_PATH = None"]
+    for opt in args.server_opt:
+        name, _, value = opt.partition("=")
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass  # 不是 Python 字面量就当字符串，例如 SOCKET_PROFILE=relay
+        setup.append(f"server.{name} = {value!r}")
+    setup.append("server.install_event_loop()")
+    setup.append(f"asyncio.run(server.main('127.0.0.1', {args.port}))")
+    return subprocess.Popen([sys.executable, "-c", "\n".join(setup)], stdout=subprocess.DEVNULL)
+
+
+async def wait_for_server(uri, timeout=10.0):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            async with websockets.connect(uri):
+                return
+        except OSError:
+            if time.time() > deadline:
+                raise RuntimeError(f"server at {uri} did not start")
+            await asyncio.sleep(0.2)
+
+
+def run(args):
+    """跑一轮负载，返回结果 dict；bench 脚本也直接调用这个函数。"""
+    plan = plan_rooms(args.clients, parse_room_sizes(args.room_sizes), args.seed)
+    rooms = [(f"load-{i}", size) for i, size in enumerate(plan)]
+    server = None
+    if args.server:
+        uri = args.server
+        pid = args.server_pid
+    else:
+        server = start_server(args)
+        uri = f"ws://127.0.0.1:{args.port}"
+        pid = server.pid
     try:
-        async with websockets.connect('ws://localhost:8765') as websocket:
-            print("连接成功!")
-            await websocket.send('{"type": "test"}')
-            response = await websocket.recv()
-            print(f"收到响应: {response}")
-    except Exception as e:
-        print(f"连接失败: {e}")
-
-asyncio.run(test_connection())
\ No newline at end of file
+        asyncio.run(wait_for_server(uri))
+        rss_idle = rss_kb(pid) if pid else None
+        # 按房间分给各个客户端进程，同一房间的玩家在同一个进程里
+        chunks = [rooms[i::args.procs] for i in range(args.procs)]
+        ready = [multiprocessing.Event() for _ in chunks]
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=client_proc, args=(uri, chunk, args, r, start, results))
+                 for chunk, r in zip(chunks, ready)]
+        for p in procs:
+            p.start()
+        connect_start = time.time()
+        for r in ready:
+            r.wait()
+        connect_time = time.time() - connect_start
+        rss_connected = rss_kb(pid) if pid else None
+        rss_peak = rss_connected
+        cpu_start = cpu_seconds(pid) if pid else None
+        start.set()
+        deadline = time.time() + args.duration + args.drain
+        while time.time() < deadline:
+            time.sleep(0.5)
+            rss = rss_kb(pid) if pid else None
+            if rss and (rss_peak is None or rss > rss_peak):
+                rss_peak = rss
+        cpu_used = cpu_seconds(pid) - cpu_start if cpu_start is not None else None
+        stats = merge(results.get() for _ in procs)
+        for p in procs:
+            p.join()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    def quantiles(h):
+        return {f"p{int(q * 100)}_ms": round(h.quantile(q) * 1000, 2) for q in (0.5, 0.95, 0.99)}
+
+    delivered = stats.received["action"] + stats.received["chat"]
+    return {
+        "clients": args.clients - stats.failed,
+        "failed": stats.failed,
+        "rooms": len(rooms),
+        "connect_seconds": round(connect_time, 2),
+        "sent_per_second": round(sum(stats.sent.values()) / args.duration, 1),
+        "delivered_per_second": round(delivered / args.duration, 1),
+        "sent": stats.sent,
+        "received": stats.received,
+        "delay": quantiles(stats.delay),
+        "slow_consumer_delay": quantiles(stats.slow_delay),
+        "rate_limited": stats.rate_limited,
+        "slow_disconnected": stats.disconnected,
+        "server_rss_kb": {"idle": rss_idle, "connected": rss_connected, "peak": rss_peak},
+        # 客户端和服务器抢同一批 CPU 时吞吐不可比，每条投递花掉的服务器 CPU 更稳定
+        "server_cpu_seconds": cpu_used,
+        "server_cpu_us_per_delivery": round(cpu_used / delivered * 1e6, 2) if cpu_used and delivered else None,
+    }
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Simulated-client load generator for server.py")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--room-sizes", default="2:0.3,8:0.4,50:0.3",
+                        help="size:weight pairs; weight is the share of clients in rooms of that size")
+    parser.add_argument("--action-rate", type=float, default=2.0, help="actions per second per client")
+    parser.add_argument("--chat-rate", type=float, default=0.1, help="chat messages per second per client")
+    parser.add_argument("--slow-share", type=float, default=0.0, help="fraction of clients that read slowly")
+    parser.add_argument("--slow-delay", type=float, default=0.05, help="seconds a slow client waits after each frame")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--drain", type=float, default=1.0, help="seconds to keep reading after senders stop")
+    parser.add_argument("--procs", type=int, default=max(1, multiprocessing.cpu_count() - 1),
+                        help="client processes")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--port", type=int, default=18765)
+    parser.add_argument("--server", default=None, help="use an already running server, e.g. ws://127.0.0.1:8765")
+    parser.add_argument("--server-pid", type=int, default=None, help="pid of --server, for memory numbers")
+    parser.add_argument("--server-opt", action="append", default=[], metavar="NAME=VALUE",
+                        help="override a server.py setting, e.g. ACTION_TICK=0.05")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    return parser
+
+
+def report(result):
+    print(f"clients {result['clients']} in {result['rooms']} rooms "
+          f"(connected in {result['connect_seconds']} s, {result['failed']} failed)")
+    print(f"sent      {result['sent_per_second']:>10} msg/s  {result['sent']}")
+    print(f"delivered {result['delivered_per_second']:>10} msg/s  {result['received']}")
+    d, s = result["delay"], result["slow_consumer_delay"]
+    print(f"delay     p50 {d['p50_ms']} ms  p95 {d['p95_ms']} ms  p99 {d['p99_ms']} ms")
+    print(f"slow      p50 {s['p50_ms']} ms  p95 {s['p95_ms']} ms  p99 {s['p99_ms']} ms  "
+          f"disconnected {result['slow_disconnected']}")
+    print(f"rate limited replies {result['rate_limited']}")
+    rss = result["server_rss_kb"]
+    if rss["idle"] is not None:
+        print(f"server RSS idle {rss['idle'] / 1024:.1f} MiB  connected {rss['connected'] / 1024:.1f} MiB  "
+              f"peak {rss['peak'] / 1024:.1f} MiB")
+    if result["server_cpu_seconds"] is not None:
+        print(f"server CPU {result['server_cpu_seconds']:.2f} s, "
+              f"{result['server_cpu_us_per_delivery']} us per delivered message")
+
+
+def main():
+    args = build_parser().parse_args()
+    result = run(args)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        report(result)
+
+
+if __name__ == "__main__":
+    main()
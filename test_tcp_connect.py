@@ -1,16 +1,234 @@
-# debug_server.py
-import socket
-import ssl
-
-# 创建一个简单的原始 TCP socket
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.connect(('localhost', 8765))
-
-# 手工发送一个格式错误的 HTTP 请求
-# 或者一个非 WebSocket 的请求，看服务器如何响应
-s.sendall(b'GET / HTTP/1.1\r\nHost: localhost:8765\r\n\r\n')
-
-# 接收服务器的响应
-response = s.recv(1024)
-print("Server raw response:", repr(response))
-s.close()
\ No newline at end of file
+# test_tcp_connect.py
+# 连接风暴基准：在本机启动 server.py，
+#   1. 尽快建立成千上万个 WebSocket 连接并加入房间，测每秒完成的握手数、握手耗时和拿到 room_players 的耗时；
+#   2. 重启服务器，所有客户端像 client10.py 的 ws_main 一样每隔 5 秒重试一次，
+#      测全部重新加入用了多久、重连高峰每秒多少握手、失败了多少次。
+# 例：python test_tcp_connect.py --clients 5000 --room-size 8
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import time
+
+import websockets
+
+import metrics
+from test_connect import DELAY_BUCKETS, JoinFailed, rss_kb, start_server, wait_for_server, wait_for_room_players
+
+
+async def connect_and_join(uri, room, player_id, timeout):
+    """返回 (ws, 握手耗时, 到收到 room_players 的耗时)。"""
+    t0 = time.perf_counter()
+    ws = await asyncio.wait_for(websockets.connect(uri, ping_interval=None, close_timeout=1), timeout)
+    handshake = time.perf_counter() - t0
+    await ws.send(json.dumps({"type": "join", "room": room, "player_id": player_id}))
+    try:
+        await wait_for_room_players(ws)
+    except JoinFailed:
+        await ws.close()
+        raise
+    return ws, handshake, time.perf_counter() - t0
+
+
+class Phase:
+    def __init__(self):
+        self.handshake = metrics.Histogram("handshake", "handshake time", DELAY_BUCKETS)
+        self.joined = metrics.Histogram("joined", "time to room_players", DELAY_BUCKETS)
+        self.done_at = []  # 每个成功加入的时间点
+        self.failures = 0
+
+    def add(self, handshake, joined):
+        self.handshake.observe(handshake)
+        self.joined.observe(joined)
+        self.done_at.append(time.time())
+
+    def as_dict(self):
+        return {"handshake": self.handshake.counts, "joined": self.joined.counts,
+                "done_at": self.done_at, "failures": self.failures}
+
+
+async def storm(uri, players, args, start, restarted, finish, results):
+    await asyncio.get_running_loop().run_in_executor(None, start.wait)
+    first = Phase()
+    sem = asyncio.Semaphore(args.concurrency or max(1, len(players)))
+    conns = {}
+
+    async def initial(room, pid):
+        # 第一次没连上的客户端和 ws_main 一样隔 retry_interval 秒再试，直到加入
+        while True:
+            try:
+                async with sem:
+                    ws, handshake, joined = await connect_and_join(uri, room, pid, args.connect_timeout)
+            except JoinFailed:
+                # 服务器明确拒绝（join_failed/redirect），重试也一样，算失败不再试
+                first.failures += 1
+                return
+            except (OSError, websockets.WebSocketException, asyncio.TimeoutError):
+                first.failures += 1
+                await asyncio.sleep(args.retry_interval + random.uniform(0, args.retry_jitter))
+                continue
+            conns[pid] = ws
+            first.add(handshake, joined)
+            return
+
+    started = time.time()
+    await asyncio.gather(*(initial(room, pid) for room, pid in players))
+    results.put(("first", started, first.as_dict()))
+
+    # 第二阶段：等服务器被重启，断开的客户端每 retry_interval 秒重试一次，直到重新加入
+    second = Phase()
+
+    async def reconnect(room, pid):
+        if pid not in conns:
+            return  # 第一阶段就没加入成功
+        await conns[pid].wait_closed()
+        while True:
+            await asyncio.sleep(args.retry_interval + random.uniform(0, args.retry_jitter))
+            try:
+                ws, handshake, joined = await connect_and_join(uri, room, pid, args.connect_timeout)
+            except JoinFailed:
+                second.failures += 1
+                return
+            except (OSError, websockets.WebSocketException, asyncio.TimeoutError):
+                second.failures += 1
+                continue
+            conns[pid] = ws
+            second.add(handshake, joined)
+            return
+
+    tasks = [asyncio.create_task(reconnect(room, pid)) for room, pid in players]
+    await asyncio.get_running_loop().run_in_executor(None, restarted.wait)
+    await asyncio.wait(tasks, timeout=args.storm_timeout)
+    for t in tasks:
+        t.cancel()
+    results.put(("second", None, second.as_dict()))
+    await asyncio.get_running_loop().run_in_executor(None, finish.wait)
+    await asyncio.gather(*(ws.close() for ws in conns.values()), return_exceptions=True)
+
+
+def storm_proc(uri, players, args, start, restarted, finish, results):
+    asyncio.run(storm(uri, players, args, start, restarted, finish, results))
+
+
+def merge(parts):
+    total = {"handshake": metrics.Histogram("handshake", "", DELAY_BUCKETS),
+             "joined": metrics.Histogram("joined", "", DELAY_BUCKETS),
+             "done_at": [], "failures": 0}
+    for part in parts:
+        for name in ("handshake", "joined"):
+            h = total[name]
+            for i, n in enumerate(part[name]):
+                h.counts[i] += n
+                h.count += n
+        total["done_at"].extend(part["done_at"])
+        total["failures"] += part["failures"]
+    return total
+
+
+def summarize(phase, since):
+    done = sorted(t - since for t in phase["done_at"])
+    per_second = {}
+    for t in done:
+        per_second[int(t)] = per_second.get(int(t), 0) + 1
+
+    def ms(h, q):
+        return round(h.quantile(q) * 1000, 2)
+
+    return {
+        "joined": len(done),
+        "failed_attempts": phase["failures"],
+        "seconds_to_all_joined": round(done[-1], 2) if done else None,
+        "joins_per_second": round(len(done) / done[-1], 1) if done and done[-1] > 0 else None,
+        "peak_joins_per_second": max(per_second.values()) if per_second else 0,
+        "handshake_ms": {f"p{q}": ms(phase["handshake"], q / 100) for q in (50, 95, 99)},
+        "room_players_ms": {f"p{q}": ms(phase["joined"], q / 100) for q in (50, 95, 99)},
+    }
+
+
+def run(args):
+    players = [(f"storm-{i // args.room_size}", f"p{i}") for i in range(args.clients)]
+    server = start_server(args)
+    uri = f"ws://127.0.0.1:{args.port}"
+    ctx = multiprocessing.get_context()
+    start, restarted, finish = ctx.Event(), ctx.Event(), ctx.Event()
+    results = ctx.Queue()
+    procs = [ctx.Process(target=storm_proc, args=(uri, players[i::args.procs], args, start, restarted, finish, results))
+             for i in range(args.procs)]
+    try:
+        asyncio.run(wait_for_server(uri))
+        rss_idle = rss_kb(server.pid)
+        for p in procs:
+            p.start()
+        start.set()
+        firsts = [results.get() for _ in procs]
+        since = min(started for _, started, _ in firsts)
+        first = summarize(merge(part for _, _, part in firsts), since)
+        rss_connected = rss_kb(server.pid)
+
+        # 模拟服务器重启：所有连接同时断开，客户端按固定间隔重试；重连阶段的耗时从停掉服务器算起
+        killed = time.time()
+        server.terminate()
+        server.wait()
+        time.sleep(args.downtime)
+        server = start_server(args)
+        asyncio.run(wait_for_server(uri))
+        restarted.set()
+        second = summarize(merge(results.get()[2] for _ in procs), killed)
+        rss_after = rss_kb(server.pid)
+        finish.set()
+        for p in procs:
+            p.join()
+    finally:
+        server.terminate()
+        server.wait()
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+    return {"clients": args.clients, "connect": first, "reconnect": second,
+            "server_rss_kb": {"idle": rss_idle, "connected": rss_connected, "after_reconnect": rss_after}}
+
+
+def report(result):
+    print(f"{result['clients']} clients")
+    for name, title in (("connect", "initial connect storm"), ("reconnect", "reconnect after restart")):
+        r = result[name]
+        print(f"{title}:")
+        print(f"  joined {r['joined']} in {r['seconds_to_all_joined']} s "
+              f"({r['joins_per_second']}/s, peak {r['peak_joins_per_second']}/s), "
+              f"{r['failed_attempts']} failed attempts")
+        h, j = r["handshake_ms"], r["room_players_ms"]
+        print(f"  handshake     p50 {h['p50']} ms  p95 {h['p95']} ms  p99 {h['p99']} ms")
+        print(f"  room_players  p50 {j['p50']} ms  p95 {j['p95']} ms  p99 {j['p99']} ms")
+    rss = result["server_rss_kb"]
+    if rss["idle"] is not None:
+        print(f"server RSS idle {rss['idle'] / 1024:.1f} MiB  connected {rss['connected'] / 1024:.1f} MiB  "
+              f"after reconnect {rss['after_reconnect'] / 1024:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Connection storm and handshake throughput benchmark for server.py")
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--room-size", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help="max handshakes in flight per client process during the first storm (0 = all at once)")
+    parser.add_argument("--connect-timeout", type=float, default=1.0, help="same as client10.py's ws_main")
+    parser.add_argument("--retry-interval", type=float, default=5.0, help="same as client10.py's ws_main")
+    parser.add_argument("--retry-jitter", type=float, default=0.0, help="extra random delay before each retry")
+    parser.add_argument("--downtime", type=float, default=1.0, help="seconds the server stays down")
+    parser.add_argument("--storm-timeout", type=float, default=120.0)
+    parser.add_argument("--procs", type=int, default=max(1, multiprocessing.cpu_count() - 1))
+    parser.add_argument("--port", type=int, default=18765)
+    parser.add_argument("--server-opt", action="append", default=[], metavar="NAME=VALUE",
+                        help="override a server.py setting, e.g. COMPRESSION=None")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+    result = run(args)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        report(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# wire.py
+# 紧凑二进制协议，客户端和服务器共用。握手时通过 WebSocket 子协议协商：
+# 选中 SUBPROTOCOL_BINARY 的连接，高频的 action/chat 帧走二进制，其余控制消息仍是 JSON 文本帧；
+# 没有协商子协议（老客户端）或选中 SUBPROTOCOL_JSON 时一切照旧。
+#
+# 帧格式（第一个字节是消息类型，整数都是 LEB128 varint）：
+#   客户端 -> 服务器
+#     ACTION   01 [count]                 count 省略时为 1
+#     CHAT     02 <utf-8 text>
+#   服务器 -> 客户端（sid 是加入房间时分配的房间内短 id）
+#     ACTION   01 sid [count]
+#     CHAT     02 sid <utf-8 text>
+#     ACTIONS  03 n (sid count) * n      一个 tick 内的动作批次
+#     CHAT_SEQ 04 sid seq <utf-8 text>     带房间序号的聊天，断线重连后据此补发
+
+SUBPROTOCOL_BINARY = "jigger.bin.v1"
+SUBPROTOCOL_JSON = "jigger.json"
+SUBPROTOCOLS = [SUBPROTOCOL_BINARY, SUBPROTOCOL_JSON]
+
+MSG_ACTION = 1
+MSG_CHAT = 2
+MSG_ACTIONS = 3
+MSG_CHAT_SEQ = 4
+
+
+def encode_varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def decode_varint(buf, pos=0):
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def is_binary_frame(frame):
+    # JSON 帧总是以 "{" 或空白开头，二进制帧的第一个字节是很小的消息类型
+    return bool(frame) and MSG_ACTION <= frame[0] <= MSG_CHAT_SEQ
+
+
+def encode_action(sid=None, count=1):
+    out = bytes((MSG_ACTION,))
+    if sid is not None:
+        out += encode_varint(sid)
+    if count != 1:
+        out += encode_varint(count)
+    return out
+
+
+def encode_chat(text, sid=None, seq=None):
+    if seq is not None:
+        return bytes((MSG_CHAT_SEQ,)) + encode_varint(sid) + encode_varint(seq) + text.encode("utf-8")
+    out = bytes((MSG_CHAT,))
+    if sid is not None:
+        out += encode_varint(sid)
+    return out + text.encode("utf-8")
+
+
+def with_seq(frame, seq):
+    """给服务器发出的 CHAT 帧加上房间序号。"""
+    data = decode(frame)
+    return encode_chat(data["text"], data["sid"], seq)
+
+
+def encode_actions(pairs):
+    out = bytearray((MSG_ACTIONS,))
+    out += encode_varint(len(pairs))
+    for sid, count in pairs:
+        out += encode_varint(sid)
+        out += encode_varint(count)
+    return bytes(out)
+
+
+def decode(frame, from_server=True):
+    """把二进制帧解成和 JSON 协议相同形状的 dict，玩家用 sid 表示。"""
+    kind = frame[0]
+    pos = 1
+    sid = None
+    if kind == MSG_ACTIONS:
+        n, pos = decode_varint(frame, pos)
+        actions = []
+        for _ in range(n):
+            sid, pos = decode_varint(frame, pos)
+            count, pos = decode_varint(frame, pos)
+            actions.append([sid, count])
+        return {"type": "actions", "actions": actions}
+    if from_server:
+        sid, pos = decode_varint(frame, pos)
+    if kind == MSG_ACTION:
+        count = decode_varint(frame, pos)[0] if pos < len(frame) else 1
+        return {"type": "action", "sid": sid, "count": count}
+    if kind == MSG_CHAT:
+        return {"type": "chat", "sid": sid, "text": frame[pos:].decode("utf-8")}
+    if kind == MSG_CHAT_SEQ:
+        seq, pos = decode_varint(frame, pos)
+        return {"type": "chat", "sid": sid, "seq": seq, "text": frame[pos:].decode("utf-8")}
+    raise ValueError(f"unknown binary message type {kind}")